@@ -1,11 +1,24 @@
 __author__ = 'anushabala'
 from argparse import ArgumentParser
+from collections import deque, namedtuple
+from itertools import islice
+from multiprocessing import Pool
+import cPickle as pickle
+import hashlib
 import math
+import sqlite3
+import time
 from events import is_int, RelativeEventSequence, AbsoluteEventSequence, CursorEventSequence
 from itertools import chain, combinations, permutations
 
 numbers = {"one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6, "seven": 7, "eight": 8, "nine": 9}
 directions = ['x', 'y']
+# bump when a change to the aligner makes previously cached alignments stale
+alignment_cache_version = 1
+default_cache_bytes = 512 * 1024 * 1024
+
+# what the aligners need to know about a sentence, computed once per description by sentence_features
+SentenceFeatures = namedtuple("SentenceFeatures", ["numbers", "is_repeat", "num_tokens"])
 
 
 def is_adjacent_relative(next_action, axis='x'):
@@ -77,13 +90,117 @@ def find_last_cursor_index(actions, start_idx, num_actions):
     return idx
 
 
+class AlignmentIndex(object):
+    '''
+    Lookup tables for one action sequence, built in O(n), that answer find_consecutive_actions, find_last_cursor_index
+    and count_aligned_actions for any segment actions[start:end] in O(1). For relative and absolute actions it stores,
+    per axis, how many adjacent placements follow each position. For cursor actions it stores prefix counts of the
+    START and BLOCK tokens, where each block was placed, and how many (move, BLOCK) pairs start at each position.
+    Segments that the scanning functions choke on raise the same exceptions here.
+    '''
+
+    def __init__(self, actions, sequence_type="relative"):
+        self.sequence_type = sequence_type
+        self.num_actions = n = len(actions)
+        if sequence_type == "cursor":
+            self.placed_positions = [i for (i, action) in enumerate(actions) if 'START' in action or 'BLOCK' in action]
+            (self.placed_before, self.starts_before, self.blocks_before) = ([0], [0], [0])
+            for action in actions:
+                self.placed_before.append(self.placed_before[-1] + ('START' in action or 'BLOCK' in action))
+                self.starts_before.append(self.starts_before[-1] + (action == ['START']))
+                self.blocks_before.append(self.blocks_before[-1] + (action == ['BLOCK']))
+            # first START and first BLOCK at or after each position
+            (self.next_start, self.next_block) = ([n] * (n + 1), [n] * (n + 1))
+            # number of steps find_consecutive_actions can take from each position, two tokens at a time
+            self.block_pairs = [0] * (n + 2)
+            for i in reversed(range(n)):
+                self.next_start[i] = i if actions[i] == ['START'] else self.next_start[i + 1]
+                self.next_block[i] = i if actions[i] == ['BLOCK'] else self.next_block[i + 1]
+                if i + 1 < n and 'BLOCK' in actions[i + 1]:
+                    self.block_pairs[i] = self.block_pairs[i + 2] + 1
+        else:
+            # events without coordinates make is_adjacent_* raise once a scan reaches them
+            self.malformed = [len(action) < 3 for action in actions]
+            if sequence_type == "absolute":
+                self.malformed = [bad or (i > 0 and self.malformed[i - 1]) for (i, bad) in enumerate(self.malformed)]
+            # adjacent_after[axis][i]: how many actions from i onwards are each adjacent to the one before them
+            self.adjacent_after = {}
+            for axis in ['x', 'y']:
+                streak = [0] * (n + 1)
+                for i in reversed(range(1, n)):
+                    if self.malformed[i]:
+                        continue
+                    if sequence_type == "relative":
+                        adjacent = is_adjacent_relative(actions[i], axis)
+                    else:
+                        adjacent = is_adjacent_absolute(actions[i], actions[i - 1], axis)
+                    streak[i] = streak[i + 1] + 1 if adjacent else 0
+                self.adjacent_after[axis] = streak
+
+    def segment(self, start, end):
+        # the bounds of actions[start:end] as indices into actions
+        (start, end, _) = slice(start, end).indices(self.num_actions)
+        return start, max(start, end)
+
+    def segment_end(self, start, num_actions):
+        # where a segment that covers num_actions actions from start ends
+        if self.sequence_type == "cursor":
+            return self.last_cursor_index(start, num_actions)
+        return start + num_actions
+
+    def last_cursor_index(self, start, num_actions):
+        # same as find_last_cursor_index(actions, start, num_actions), for start >= 0
+        target = self.placed_before[min(start, self.num_actions)] + num_actions
+        if num_actions >= 1 and target <= len(self.placed_positions):
+            return self.placed_positions[target - 1] + 1
+        return max(start, self.num_actions)
+
+    def num_aligned(self, start, end):
+        # same as count_aligned_actions(actions[start:end], sequence_type)
+        (start, end) = self.segment(start, end)
+        if self.sequence_type == "cursor":
+            num_starts = self.starts_before[end] - self.starts_before[start]
+            return self.blocks_before[end] - self.blocks_before[start] + (1 if num_starts > 0 else 0)
+        return end - start
+
+    def consecutive_actions(self, start, end):
+        # same as find_consecutive_actions(actions[start:end], 0, sequence_type)
+        (start, end) = self.segment(start, end)
+        if start == end:
+            raise IndexError("list index out of range")
+        if self.sequence_type == "cursor":
+            if self.starts_before[end] > self.starts_before[start]:
+                i = self.next_start[start] + 1
+            elif self.blocks_before[end] > self.blocks_before[start]:
+                i = self.next_block[start] + 1
+            else:
+                raise ValueError("['BLOCK'] is not in list")
+            steps = min(self.block_pairs[i], (end - i) // 2)
+            if i + 2 * steps == end - 1:
+                # the scan looks one token past the end of the segment
+                raise IndexError("list index out of range")
+            return 1 + steps
+
+        consecutive_tokens = []
+        for axis in directions:
+            following = self.adjacent_after[axis][start + 1]
+            stop = start + 1 + following
+            if stop < end and self.malformed[stop]:
+                raise IndexError("list index out of range")
+            consecutive_tokens.append(min(1 + following, end - start))
+        return max(consecutive_tokens)
+
+
 def find_numbers(sentence):
+    return numbers_in_tokens(sentence.split())
+
+
+def numbers_in_tokens(tokens):
     nums = list()
-    tokens = sentence.split()
     for token in tokens:
-        if token in numbers.keys():
+        if token in numbers:
             nums.append(numbers[token])
-        elif is_int(token):
+        elif (token[0].isdigit() or token[0] in "+-") and is_int(token):
             nums.append(int(token))
 
     return nums
@@ -93,6 +210,15 @@ def is_repeat_instruction(sentence):
     return True if "repeat" in sentence else False
 
 
+def sentence_features(sentence):
+    tokens = sentence.split()
+    return SentenceFeatures(tuple(numbers_in_tokens(tokens)), is_repeat_instruction(sentence), len(tokens))
+
+
+def split_sentences(sentences_str):
+    return sentences_str.strip().split(" . ")
+
+
 # todo (anushabala) complete this to use combinations of numbers in sentences while creating an alignment
 # e.g. if the sentence has 1 and 3, return all possible permutations of everything in the powerset of (1,3)
 def find_actions_per_sentence(sentence):
@@ -103,27 +229,31 @@ def find_actions_per_sentence(sentence):
     return set(perms)
 
 
-def find_segmentations(sentences, current_path, paths, total_actions):
+def find_segmentations(sentences, current_path, paths, total_actions, features=None):
+    if features is None:
+        features = [sentence_features(sentence) for sentence in sentences]
     if not sentences:
         if sum(current_path) == total_actions:
             paths.append(current_path)
         return
 
-    nums = find_numbers(sentences[0])
+    nums = list(features[0].numbers)
     if not nums:
         nums.append(1)
-    if is_repeat_instruction(sentences[0]) and current_path and current_path[-1] not in nums:
+    if features[0].is_repeat and current_path and current_path[-1] not in nums:
         nums.append(current_path[-1])
     for num in nums:
         new_path = list(current_path)
         new_path.append(num)
-        find_segmentations(sentences[1:], new_path, paths, total_actions)
+        find_segmentations(sentences[1:], new_path, paths, total_actions, features[1:])
 
 
 # todo (anushabala) complete this to use combinations of numbers in sentences while creating an alignment
-def better_align(sentences, actions):
+def better_align(sentences, actions, features=None):
+    if features is None:
+        features = [sentence_features(sentence) for sentence in sentences]
     segmentations = []
-    find_segmentations(sentences, [], segmentations, len(actions))
+    find_segmentations(sentences, [], segmentations, len(actions), features)
     sentence_alignments = []
 
     for path in segmentations:
@@ -154,47 +284,99 @@ def better_align(sentences, actions):
 
     if not sentence_alignments:
         return 0, None, None
-    scored_alignments = [(score_smart_alignment(alignment, path), alignment, path) for (alignment, path) in
+    scored_alignments = [(score_smart_alignment(alignment, path, features), alignment, path) for (alignment, path) in
                          sentence_alignments]
     return max(scored_alignments, key=lambda x: x[0])
 
 
-def heuristic_align(sentences, actions, sequence_type="relative"):
-    segmentations = []
-    max_actions = actions.count(["BLOCK"]) + 1 if sequence_type == "cursor" else len(actions)
-    find_segmentations(sentences, [], segmentations, max_actions)
-    sentence_alignments = []
-    for path in segmentations:
-        action_idx = 0
-        alignment = []
-
-        for (i, num_actions) in enumerate(path):
-            if sequence_type == "cursor":
-                end_idx = find_last_cursor_index(actions, action_idx, num_actions)
-                aligned_actions = actions[action_idx: end_idx]
+def segment_options(nums, is_repeat, prev_num):
+    # the number of actions a sentence may cover, in the order find_segmentations tries them
+    options = list(nums) if nums else [1]
+    if is_repeat and prev_num is not None and prev_num not in options:
+        options.append(prev_num)
+    return [num for (i, num) in enumerate(options) if num not in options[:i]]
+
+
+def top_alignments(sentences, actions, sequence_type="relative", k=1, features=None):
+    '''
+    Finds the k best-scoring ways of assigning actions to sentences, where each sentence covers one of the numbers it
+    mentions (see find_segmentations) and the numbers add up to the number of actions. score_alignment is a sum of
+    per-sentence scores that depend only on the sentence, its actions and the number of actions aligned to the previous
+    sentence, so this is a Viterbi search over (sentence, action position, actions assigned so far, previous choice)
+    instead of a scan over every segmentation. Returns a list of (score, alignment, path) tuples, best first, with ties
+    in the order find_segmentations lists the paths; heuristic_align returns the first one. Segments are scored with
+    an AlignmentIndex, so each one costs O(1). features are the SentenceFeatures of the sentences, if already known.
+    '''
+    if features is None:
+        features = [sentence_features(sentence) for sentence in sentences]
+    index = AlignmentIndex(actions, sequence_type)
+    total_actions = actions.count(["BLOCK"]) + 1 if sequence_type == "cursor" else len(actions)
+    sentence_nums = [f.numbers for f in features]
+    repeats = [f.is_repeat for f in features]
+    num_sentences = len(sentences)
+    completions = {}
+    best = {}
+
+    def can_complete(i, assigned, prev_num):
+        if i == num_sentences:
+            return assigned == total_actions
+        key = (i, assigned, prev_num if repeats[i] else None)
+        if key not in completions:
+            completions[key] = any(can_complete(i + 1, assigned + num, num)
+                                   for num in segment_options(sentence_nums[i], repeats[i], prev_num))
+        return completions[key]
+
+    def search(i, action_idx, assigned, prev_num, prev_actions):
+        # the k best (score, choice order, path) completions for sentences i onwards
+        if i == num_sentences:
+            return [(0, (), ())]
+        key = (i, action_idx, assigned) + ((prev_num, prev_actions) if repeats[i] else (None, None))
+        if key not in best:
+            candidates = []
+            for (choice, num) in enumerate(segment_options(sentence_nums[i], repeats[i], prev_num)):
+                # only segments that can still be completed are scored, just like the paths find_segmentations lists
+                if not can_complete(i + 1, assigned + num, num):
+                    continue
+                next_idx = index.segment_end(action_idx, num)
+                num_aligned_actions = index.num_aligned(action_idx, next_idx)
+                num_consecutive_actions = index.consecutive_actions(action_idx, next_idx)
+                score = score_segment(features[i], num_aligned_actions, num_consecutive_actions, prev_actions)
+                for (rest_score, rest_order, rest_path) in search(i + 1, next_idx, assigned + num, num, num_aligned_actions):
+                    candidates.append((score + rest_score, (choice,) + rest_order, (num,) + rest_path))
+            candidates.sort(key=lambda c: (-c[0], c[1]))
+            best[key] = candidates[:k]
+        return best[key]
+
+    results = []
+    if can_complete(0, 0, None):
+        for (score, order, path) in search(0, 0, 0, None, -1):
+            action_idx = 0
+            alignment = []
+            for (sentence, num_actions) in zip(sentences, path):
+                end_idx = index.segment_end(action_idx, num_actions)
+                alignment.append((sentence, actions[action_idx:end_idx]))
                 action_idx = end_idx
-            else:
-                aligned_actions = actions[action_idx:action_idx + num_actions]
-                action_idx += num_actions
-            alignment.append((sentences[i], aligned_actions))
-        if alignment:
-            sentence_alignments.append((alignment, path))
+            results.append((score, alignment, list(path)))
+    return results
 
-    if not sentence_alignments:
+
+def heuristic_align(sentences, actions, sequence_type="relative", features=None):
+    alignments = top_alignments(sentences, actions, sequence_type, features=features)
+    if not alignments:
         return 0, None, None
-    scored_alignments = [(score_alignment(alignment, sequence_type), alignment, path) for (alignment, path) in
-                         sentence_alignments]
-    return max(scored_alignments, key=lambda x: x[0])
+    return alignments[0]
 
 
 # todo (anushabala) complete this to score alignments made by finding combinations of numbers in sentences
-def score_smart_alignment(alignment, path):
+def score_smart_alignment(alignment, path, features=None):
+    if features is None:
+        features = [sentence_features(sentence) for (sentence, aligned_actions) in alignment]
     score = 0
     prev_actions = -1
     for (idx, (sentence, aligned_actions)) in enumerate(alignment):
-        nums = find_numbers(sentence)
+        nums = features[idx].numbers
 
-        if is_repeat_instruction(sentence):
+        if features[idx].is_repeat:
             score = score + 1 if len(aligned_actions) == prev_actions else score - 1
         elif not nums:
             score = score + 1 if len(aligned_actions) == 1 else score - 1
@@ -206,22 +388,35 @@ def score_smart_alignment(alignment, path):
     return score
 
 
-def score_alignment(alignment, sequence_type="relative"):
+def count_aligned_actions(aligned_actions, sequence_type="relative"):
+    if sequence_type == "cursor":
+        num_aligned_actions = 0
+        if ['BLOCK'] in aligned_actions:
+            num_aligned_actions += aligned_actions.count(['BLOCK'])
+        if ['START'] in aligned_actions:
+            num_aligned_actions += 1
+        return num_aligned_actions
+    return len(aligned_actions)
+
+
+def score_segment(features, num_aligned_actions, num_consecutive_actions, prev_actions):
+    # the score of one sentence of an alignment, given its SentenceFeatures
+    score = 0
+    if features.is_repeat:
+        score = score + 1 if num_aligned_actions == prev_actions else score - 1
+    score = score + 1 if num_aligned_actions <= num_consecutive_actions else score - 1
+    return score
+
+
+def score_alignment(alignment, sequence_type="relative", features=None):
+    if features is None:
+        features = [sentence_features(sentence) for (sentence, aligned_actions) in alignment]
     alignment_score = 0
     prev_actions = -1
-    for (idx, (sentence, aligned_actions)) in enumerate(alignment):
-        num_aligned_actions = len(aligned_actions)
-        if sequence_type == "cursor":
-            num_aligned_actions = 0
-            if ['BLOCK'] in aligned_actions:
-                num_aligned_actions += aligned_actions.count(['BLOCK'])
-            if ['START'] in aligned_actions:
-                num_aligned_actions += 1
-        if is_repeat_instruction(sentence):
-            alignment_score = alignment_score + 1 if num_aligned_actions == prev_actions else alignment_score - 1
-
+    for ((sentence, aligned_actions), sentence_feats) in zip(alignment, features):
+        num_aligned_actions = count_aligned_actions(aligned_actions, sequence_type)
         num_consecutive_actions = find_consecutive_actions(aligned_actions, 0, sequence_type)
-        alignment_score = alignment_score + 1 if num_aligned_actions <= num_consecutive_actions else alignment_score - 1
+        alignment_score += score_segment(sentence_feats, num_aligned_actions, num_consecutive_actions, prev_actions)
         prev_actions = num_aligned_actions
     return alignment_score
 
@@ -256,7 +451,7 @@ def write_examples(alignments, output_file):
         output_file.write("%s\n" % actions_to_str(aligned_actions[-1]))
 
 
-def align_sequences(sentences, actions, sequence_type, alignment_type, backup_using_naive=False):
+def align_sequences(sentences, actions, sequence_type, alignment_type, backup_using_naive=False, features=None):
     # TODO: consider handling different sequence types by first converting to absolute
     #       so that we don't need sequence_type-specific code
     bad_alignment_info = {"is_heuristically_alignable": False}
@@ -267,7 +462,7 @@ def align_sequences(sentences, actions, sequence_type, alignment_type, backup_us
         return (alignments, bad_alignment_info)
 
     elif alignment_type == "clever":
-        (score, alignments, path) = heuristic_align(sentences, actions, sequence_type)
+        (score, alignments, path) = heuristic_align(sentences, actions, sequence_type, features)
         if score >= len(sentences) - 4 and alignments:
             good_alignment_info["score_percentage"] = float(score)/float(len(sentences))
             return (alignments,good_alignment_info)
@@ -294,12 +489,166 @@ def get_event_sequence(action_str, seq_type, bitmap_dim):
         return event_sequence.events
 
 
-def align_strings(sentences_str, actions_str, sequence_type, alignment_type, bitmap_dim, backup_using_naive=False):
-    sentences = sentences_str.strip().split(" . ")
+def align_strings(sentences_str, actions_str, sequence_type, alignment_type, bitmap_dim, backup_using_naive=False, cache=None,
+                  features=None):
+    if cache is not None:
+        key = AlignmentCache.key(sentences_str, actions_str, sequence_type, alignment_type, bitmap_dim, backup_using_naive)
+        result = cache.get(key)
+        if result is None:
+            result = align_strings(sentences_str, actions_str, sequence_type, alignment_type, bitmap_dim, backup_using_naive,
+                                   features=features)
+            cache.put(key, result)
+        return result
+    sentences = split_sentences(sentences_str)
     actions = get_event_sequence(actions_str, sequence_type, bitmap_dim)
-    return align_sequences(sentences, actions, sequence_type, alignment_type, backup_using_naive=backup_using_naive)
-
+    return align_sequences(sentences, actions, sequence_type, alignment_type, backup_using_naive=backup_using_naive,
+                           features=features)
+
+
+class AlignmentCache(object):
+    '''
+    Keeps align_strings results in an SQLite file so that rebuilding a dataset only aligns the rows that changed. Keys
+    are SHA-1 hashes of the align_strings arguments, values are pickled results. Once the pickled results take up more
+    than max_bytes, the least recently used ones are evicted. Only one process may write to the file. Other processes
+    can open it with read_only=True and report their hits and new results back to the writer (see touch and put).
+    '''
+
+    def __init__(self, path, max_bytes=default_cache_bytes, read_only=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.read_only = read_only
+        self.connection = sqlite3.connect(path)
+        if not read_only:
+            # readers in other processes do not block the writer in WAL mode
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS alignments "
+                                    "(key TEXT PRIMARY KEY, value BLOB, size INTEGER, last_used INTEGER)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS alignments_last_used ON alignments (last_used)")
+            self.connection.commit()
+        (self.clock, self.total_bytes) = self.connection.execute(
+            "SELECT COALESCE(MAX(last_used), 0), COALESCE(SUM(size), 0) FROM alignments").fetchone()
+        self.hits = 0
+        self.misses = 0
+        self.uncommitted = 0
+
+    @staticmethod
+    def key(sentences_str, actions_str, sequence_type, alignment_type, bitmap_dim, backup_using_naive=False):
+        fields = [alignment_cache_version, sentences_str, actions_str, sequence_type, alignment_type, bitmap_dim, backup_using_naive]
+        fields = [f.encode("utf-8") if isinstance(f, unicode) else str(f) for f in fields]
+        return hashlib.sha1("\t".join(fields)).hexdigest()
+
+    def get(self, key):
+        row = self.connection.execute("SELECT value FROM alignments WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if not self.read_only:
+            self.clock += 1
+            self.connection.execute("UPDATE alignments SET last_used = ? WHERE key = ?", (self.clock, key))
+        return pickle.loads(str(row[0]))
+
+    def touch(self, key):
+        # records a hit on key that another process read from the file
+        self.hits += 1
+        self.clock += 1
+        self.connection.execute("UPDATE alignments SET last_used = ? WHERE key = ?", (self.clock, key))
+
+    def put(self, key, result):
+        assert not self.read_only, "cannot add alignments to a read-only cache"
+        value = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        old = self.connection.execute("SELECT size FROM alignments WHERE key = ?", (key,)).fetchone()
+        self.clock += 1
+        self.connection.execute("INSERT OR REPLACE INTO alignments VALUES (?, ?, ?, ?)",
+                                (key, sqlite3.Binary(value), len(value), self.clock))
+        self.total_bytes += len(value) - (old[0] if old else 0)
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+        self.uncommitted += 1
+        if self.uncommitted >= 1000:
+            self.connection.commit()
+            self.uncommitted = 0
+
+    def evict(self):
+        # drop the least recently used results until the cache is back under three quarters of its limit
+        target = self.max_bytes * 3 // 4
+        evicted = []
+        for (key, size) in self.connection.execute("SELECT key, size FROM alignments ORDER BY last_used"):
+            if self.total_bytes <= target:
+                break
+            evicted.append((key,))
+            self.total_bytes -= size
+        self.connection.executemany("DELETE FROM alignments WHERE key = ?", evicted)
+
+    def close(self):
+        if not self.read_only:
+            self.connection.commit()
+        self.connection.close()
+
+
+def set_directions(axes):
+    global directions
+    directions = axes
+
+
+def align_rows(rows, sequence_type, alignment_type, bitmap_dim, backup_using_naive=False):
+    return [align_strings(command_str, action_str, sequence_type, alignment_type, bitmap_dim, backup_using_naive=backup_using_naive)
+            for (command_str, action_str) in rows]
+
+
+def stream_alignments(rows, sequence_type, alignment_type, bitmap_dim, backup_using_naive=False, workers=1, chunk_size=100,
+                      cache=None):
+    '''
+    Aligns an iterable of (command_str, action_str) rows and yields the (alignments, info) result for each row in input
+    order. With workers > 1, chunks of rows are aligned in a process pool with at most 2 * workers chunks in flight, so
+    rows are only read from the input as fast as they are aligned. Rows found in the AlignmentCache cache are not
+    aligned again, and new results are added to it.
+    '''
+    rows = iter(rows)
+    chunks = iter(lambda: list(islice(rows, chunk_size)), [])
+    args = (sequence_type, alignment_type, bitmap_dim, backup_using_naive)
+
+    def lookup(chunk):
+        # the cached result for each row (None if there is none), and the rows that still have to be aligned
+        if cache is None:
+            return [], [None] * len(chunk), chunk
+        keys = [AlignmentCache.key(command_str, action_str, *args) for (command_str, action_str) in chunk]
+        cached = [cache.get(key) for key in keys]
+        return keys, cached, [row for (row, result) in zip(chunk, cached) if result is None]
+
+    def merge(keys, cached, aligned):
+        aligned = iter(aligned)
+        for (i, result) in enumerate(cached):
+            if result is None:
+                result = next(aligned)
+                if cache is not None:
+                    cache.put(keys[i], result)
+            yield result
+
+    if workers <= 1:
+        for chunk in chunks:
+            (keys, cached, missing) = lookup(chunk)
+            for result in merge(keys, cached, align_rows(missing, *args)):
+                yield result
+        return
 
+    pool = Pool(workers, initializer=set_directions, initargs=(directions,))
+    pending = deque()
+    try:
+        for chunk in chunks:
+            (keys, cached, missing) = lookup(chunk)
+            pending.append((keys, cached, pool.apply_async(align_rows, (missing,) + args)))
+            if len(pending) >= 2 * workers:
+                (keys, cached, aligned) = pending.popleft()
+                for result in merge(keys, cached, aligned.get()):
+                    yield result
+        while pending:
+            (keys, cached, aligned) = pending.popleft()
+            for result in merge(keys, cached, aligned.get()):
+                yield result
+    finally:
+        pool.terminate()
+        pool.join()
 
 
 if __name__ == "__main__":
@@ -312,35 +661,41 @@ if __name__ == "__main__":
                                                                              ",'absolute', or 'cursor'. Defaults to relative.")
     parser.add_argument("-all", action='store_true', help="Output all data, even unalignable data.")
     parser.add_argument("-bitmap_dim", type=int, default=25, help="Width of bitmap (assumed square)")
+    parser.add_argument("-workers", type=int, default=1, help="Number of processes to align rows with")
+    parser.add_argument("-chunk_size", type=int, default=100, help="Number of rows sent to a worker at a time")
+    parser.add_argument("-align_cache", type=str, default="", help="SQLite file to cache alignments in between runs (default: no cache)")
+    parser.add_argument("-align_cache_mb", type=int, default=default_cache_bytes // (1024 * 1024), help="Size limit of the alignment cache in MB")
     args = parser.parse_args()
-    infile = open(args.tsv, 'Ur')
-    raw_data = [line.strip().split("\t") for line in infile.readlines()]
-    all_alignments = []
-    positive_score = 0
-    neg_score = 0
-    print "{} lines total".format(len(raw_data))
     if args.sequence_type == "cursor":
         directions = ["x"]
+    cache = AlignmentCache(args.align_cache, args.align_cache_mb * 1024 * 1024) if args.align_cache else None
 
-    count = 0;
-    for (command_str, action_str) in raw_data:
-        count += 1
-        if count % 100 == 0:
-            print "{}".format(count)
-
-        align,info = align_strings(command_str, action_str, args.sequence_type, args.alignment_type, args.bitmap_dim, backup_using_naive=args.all)
-        if align:
-            all_alignments.append(a)
-
-            if info["is_heuristically_alignable"]:
-                positive_score += 1
+    positive_score = 0
+    neg_score = 0
+    count = 0
+    start_time = time.time()
+    with open(args.tsv, 'Ur') as infile, open(args.output, 'w') as outfile:
+        raw_data = (line.strip().split("\t") for line in infile)
+        for (alignment, info) in stream_alignments(raw_data, args.sequence_type, args.alignment_type, args.bitmap_dim,
+                                                   backup_using_naive=args.all, workers=args.workers,
+                                                   chunk_size=args.chunk_size, cache=cache):
+            count += 1
+            if count % 1000 == 0:
+                print "Progress: %d (%.1f rows/s)" % (count, count / (time.time() - start_time))
+
+            if alignment:
+                write_examples([alignment], outfile)
+                if info["is_heuristically_alignable"]:
+                    positive_score += 1
+                else:
+                    neg_score += 1
             else:
                 neg_score += 1
-        else:
-            neg_score += 1
-            
 
-    print "(%d/%d) with score > (# of sentences - 4)" % (positive_score, len(raw_data))
-    print "(%d/%d) with score < (# of sentences - 4)" % (neg_score, len(raw_data))
-    outfile = open(args.output, 'w')
-    write_examples(all_alignments, outfile)
+    elapsed = time.time() - start_time
+    if cache is not None:
+        print "Alignment cache: %d hits, %d misses" % (cache.hits, cache.misses)
+        cache.close()
+    print "(%d/%d) with score > (# of sentences - 4)" % (positive_score, count)
+    print "(%d/%d) with score < (# of sentences - 4)" % (neg_score, count)
+    print "Aligned %d rows in %.1fs (%.1f rows/s)" % (count, elapsed, count / max(elapsed, 1e-9))
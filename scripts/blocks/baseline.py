@@ -5,7 +5,6 @@ import random
 import evaluate
 import events
 import numpy as np
-import bitmap
 
 
 def load_data(train_file, test_file):
@@ -22,35 +21,30 @@ def pick_random(dataset):
     return dataset[random.randint(0, len(dataset) - 1)]
 
 
-def run_baseline(test_data, train_data, baseline_type="random_train", aligned=False, verbose=False):
-    total_hamming_distance = 0.0
+def run_baseline(test_data, train_data, baseline_type="random_train", aligned=False, verbose=False, workers=1, bitmap_dim=15):
     source_dataset = train_data if baseline_type == "random_test" else test_data
+    true_sequences = []
+    pred_sequences = []
     ctr = 0
     for example in test_data:
 
         selected = pick_random(source_dataset)
         if aligned:
-            true_sequence_absolute = events.AbsoluteEventSequence.from_aligned_string(example[1])
-            pred_sequence_absolute = events.AbsoluteEventSequence.from_aligned_string(selected[1])
+            true_sequences.append(events.AbsoluteEventSequence.from_aligned_string(example[1]))
+            pred_sequences.append(events.AbsoluteEventSequence.from_aligned_string(selected[1]))
         else:
-            true_sequence_absolute = events.AbsoluteEventSequence.from_string(example[1])
-            pred_sequence_absolute = events.AbsoluteEventSequence.from_string(selected[1])
-
-        bmpmaker.clear()
-        bmpmaker.process_commands(true_sequence_absolute.events)
-        true_bitmap = np.array(bmpmaker.bitmap)
-
-        bmpmaker.clear()
-        bmpmaker.process_commands(pred_sequence_absolute.events)
-        pred_bitmap = np.array(bmpmaker.bitmap)
-
-        hamming = evaluate.evaluate(true_bitmap, pred_bitmap)
-        total_hamming_distance += hamming
+            true_sequences.append(events.AbsoluteEventSequence.from_string(example[1]))
+            pred_sequences.append(events.AbsoluteEventSequence.from_string(selected[1]))
 
         ctr += 1
         if verbose and ctr % 500 == 0:
             print "Progress: %d" % ctr
 
+    hamming_distances, shifts, num_off_grid = evaluate.evaluate_sequences(true_sequences, pred_sequences, (bitmap_dim, bitmap_dim), workers=workers)
+    if num_off_grid:
+        print "Warning: %d examples have blocks outside the %dx%d grid; they were scored on sparse boards" % (num_off_grid, bitmap_dim, bitmap_dim)
+    total_hamming_distance = float(np.sum(hamming_distances))
+
     avg_hamming = total_hamming_distance / len(test_data)
     print "Average Hamming distance: %2.2f" % avg_hamming
 
@@ -67,14 +61,14 @@ if __name__ == "__main__":
     parser.add_argument("-sequence_type", type=str, default="raw",
                         help="Type of sequence data (either 'raw' or 'aligned'")
     parser.add_argument("-v", type=bool, default=False, help="Print progress of baseline evaluation")
+    parser.add_argument("-workers", type=int, default=1, help="Number of processes to compute Hamming distances with")
     args = parser.parse_args()
 
     bitmap_dim = args.bitmap_dim
 
-    bmpmaker = bitmap.BitmapMaker(args.bitmap_dim, args.bitmap_dim)
     if args.baseline_type != "random_train" and args.baseline_type != "random_test":
         raise ValueError("Baseline type should be either random_train or random_test")
     train, test = load_data(args.train_file, args.test_file)
     random.seed(0)
     aligned = True if args.sequence_type == "aligned" else False
-    run_baseline(test, train, args.baseline_type, aligned, verbose=args.v)
+    run_baseline(test, train, args.baseline_type, aligned, verbose=args.v, workers=args.workers, bitmap_dim=bitmap_dim)
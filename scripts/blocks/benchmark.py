@@ -0,0 +1,351 @@
+'''
+Micro-benchmarks for the hot paths of the blocks pipeline. Each task times the current implementation against a
+straightforward reference version on real data from the repository and checks that both produce the same output.
+Run python benchmark.py -h for details.
+'''
+import argparse
+import csv
+import glob
+import re
+import time
+from collections import defaultdict
+import numpy as np
+import align
+import evaluate
+from bitmap import BitmapMaker
+from events import AbsoluteEventSequence, is_int
+from treebank_tokenizer import TreebankWordTokenizer
+
+
+def time_call(fn, *args):
+    start = time.time()
+    result = fn(*args)
+    return result, time.time() - start
+
+
+def report(name, reference_time, current_time, num_items):
+    print "%s: %d items" % (name, num_items)
+    print "  reference: %8.3fs (%.3f ms/item)" % (reference_time, 1000.0 * reference_time / max(num_items, 1))
+    print "  current:   %8.3fs (%.3f ms/item)" % (current_time, 1000.0 * current_time / max(num_items, 1))
+    print "  speedup:   %8.1fx" % (reference_time / max(current_time, 1e-9))
+
+
+# Reference (cell-by-cell) versions of the evaluate.py primitives
+
+def reference_hamming_distance(truth, pred):
+    dist = 0
+    (rows, cols) = truth.shape
+    for i in range(0, rows):
+        for j in range(0, cols):
+            if truth[i, j] != pred[i, j]:
+                dist += 1
+    return dist
+
+
+def reference_translate(bmp, xdiff=0, ydiff=0):
+    if xdiff == 0 and ydiff == 0:
+        return bmp, 0
+    removed_blocks = 0
+    aligned_bmp = np.zeros(bmp.shape, dtype=int)
+    (rows, cols) = bmp.shape
+    for i in range(0, rows):
+        for j in range(0, cols):
+            if bmp[i, j] == 1:
+                if (i - xdiff) in range(0, rows) and (j - ydiff) in range(0, cols):
+                    aligned_bmp[i - xdiff, j - ydiff] = 1
+                else:
+                    removed_blocks += 1
+    return aligned_bmp, removed_blocks
+
+
+def reference_find_corner(bmp):
+    x = -1
+    y = -1
+    rows, cols = bmp.shape
+    for i in range(0, rows):
+        if 1 in bmp[i, :]:
+            x = i
+            break
+    for i in range(0, cols):
+        if 1 in bmp[:, i]:
+            y = i
+            break
+    return (x, y)
+
+
+def reference_evaluate(truth, pred):
+    (xdiff, ydiff) = reference_find_corner(truth)
+    pred_corner = reference_find_corner(pred)
+    hamming_distances = []
+    search_space = [(xdiff, ydiff)]
+    search_space.extend([(x_offset, ydiff) for x_offset in range(xdiff - 5, xdiff + 5) if x_offset != xdiff])
+    search_space.extend([(xdiff, y_offset) for y_offset in range(ydiff - 5, ydiff + 5) if y_offset != ydiff])
+    search_space.extend([(x_offset, y_offset) for x_offset in range(xdiff - 5, xdiff + 5) for y_offset in range(ydiff - 5, ydiff + 5) if x_offset != xdiff and y_offset != ydiff])
+
+    for (x_offset, y_offset) in search_space:
+        aligned_pred, removed_blocks = reference_translate(pred, pred_corner[0] - x_offset, pred_corner[1] - y_offset)
+        distance = reference_hamming_distance(truth, aligned_pred) + removed_blocks
+        hamming_distances.append(distance)
+        if distance == 0:
+            break
+
+    return min(hamming_distances)
+
+
+# Reference versions of the align.py segmentation search, which recompute sentence features on every call
+
+def reference_find_numbers(sentence):
+    nums = list()
+    tokens = sentence.split()
+    for token in tokens:
+        if token in align.numbers.keys():
+            nums.append(align.numbers[token])
+        elif is_int(token):
+            nums.append(int(token))
+    return nums
+
+
+def reference_find_segmentations(sentences, current_path, paths, total_actions):
+    if not sentences:
+        if sum(current_path) == total_actions:
+            paths.append(current_path)
+        return
+
+    nums = reference_find_numbers(sentences[0])
+    if not nums:
+        nums.append(1)
+    if align.is_repeat_instruction(sentences[0]) and current_path and current_path[-1] not in nums:
+        nums.append(current_path[-1])
+    for num in nums:
+        new_path = list(current_path)
+        new_path.append(num)
+        reference_find_segmentations(sentences[1:], new_path, paths, total_actions)
+
+
+def reference_score_alignment(alignment, sequence_type="relative"):
+    alignment_score = 0
+    prev_actions = -1
+    for (idx, (sentence, aligned_actions)) in enumerate(alignment):
+        num_aligned_actions = align.count_aligned_actions(aligned_actions, sequence_type)
+        if align.is_repeat_instruction(sentence):
+            alignment_score = alignment_score + 1 if num_aligned_actions == prev_actions else alignment_score - 1
+
+        num_consecutive_actions = align.find_consecutive_actions(aligned_actions, 0, sequence_type)
+        alignment_score = alignment_score + 1 if num_aligned_actions <= num_consecutive_actions else alignment_score - 1
+        prev_actions = num_aligned_actions
+    return alignment_score
+
+
+def reference_heuristic_align(sentences, actions, sequence_type="relative"):
+    segmentations = []
+    max_actions = actions.count(["BLOCK"]) + 1 if sequence_type == "cursor" else len(actions)
+    reference_find_segmentations(sentences, [], segmentations, max_actions)
+    sentence_alignments = []
+    for path in segmentations:
+        action_idx = 0
+        alignment = []
+        for (i, num_actions) in enumerate(path):
+            if sequence_type == "cursor":
+                end_idx = align.find_last_cursor_index(actions, action_idx, num_actions)
+                aligned_actions = actions[action_idx: end_idx]
+                action_idx = end_idx
+            else:
+                aligned_actions = actions[action_idx:action_idx + num_actions]
+                action_idx += num_actions
+            alignment.append((sentences[i], aligned_actions))
+        if alignment:
+            sentence_alignments.append((alignment, path))
+
+    if not sentence_alignments:
+        return 0, None, None
+    scored_alignments = [(reference_score_alignment(alignment, sequence_type), alignment, path) for (alignment, path) in
+                         sentence_alignments]
+    return max(scored_alignments, key=lambda x: x[0])
+
+
+# Reference version of TreebankWordTokenizer.tokenize, with string patterns looked up in the re module cache
+
+def reference_tokenize(text):
+    text = re.sub(r'^\"', r'``', text)
+    text = re.sub(r'(``)', r' \1 ', text)
+    text = re.sub(r'([ (\[{<])"', r'\1 `` ', text)
+
+    text = re.sub(r'([:,])([^\d])', r' \1 \2', text)
+    text = re.sub(r'([:,])$', r' \1 ', text)
+    text = re.sub(r'\.\.\.', r' ... ', text)
+    text = re.sub(r'[;@#$%&]', r' \g<0> ', text)
+    text = re.sub(r'([^\.])(\.)([\]\)}>"\']*)\s*$', r'\1 \2\3 ', text)
+    text = re.sub(r'[?!]', r' \g<0> ', text)
+
+    text = re.sub(r"([^'])' ", r"\1 ' ", text)
+
+    text = re.sub(r'[\]\[\(\)\{\}\<\>]', r' \g<0> ', text)
+    text = re.sub(r'--', r' -- ', text)
+
+    text = " " + text + " "
+
+    text = re.sub(r'"', " '' ", text)
+    text = re.sub(r'(\S)(\'\')', r'\1 \2 ', text)
+
+    text = re.sub(r"([^' ])('[sS]|'[mM]|'[dD]|') ", r"\1 \2 ", text)
+    text = re.sub(r"([^' ])('ll|'LL|'re|'RE|'ve|'VE|n't|N'T) ", r"\1 \2 ",
+                  text)
+
+    for regexp in TreebankWordTokenizer.CONTRACTIONS2:
+        text = regexp.sub(r' \1 \2 ', text)
+    for regexp in TreebankWordTokenizer.CONTRACTIONS3:
+        text = regexp.sub(r' \1 \2 ', text)
+
+    text = re.sub(r'\.',' . ', text).strip()
+
+    return text.split()
+
+
+def load_drawing_pairs(csv_files, image_field, draw_events_field, bitmap_dim):
+    # pair every drawing with the first drawing of the same image, so that the pairs look like real evaluation inputs
+    bmpmaker = BitmapMaker(bitmap_dim, bitmap_dim)
+    drawings = defaultdict(list)
+    for csv_file in csv_files:
+        with open(csv_file) as fin:
+            reader = csv.reader(fin)
+            header = next(reader)
+            image_idx = header.index(image_field)
+            actions_idx = header.index(draw_events_field)
+            for row in reader:
+                try:
+                    events = AbsoluteEventSequence.from_mturk_string(row[actions_idx], canonicalize=True).events
+                    bmpmaker.clear()
+                    bmpmaker.process_commands(events)
+                except (ValueError, IndexError, AssertionError):
+                    continue
+                drawings[row[image_idx]].append(bmpmaker.bitmap.copy())
+
+    pairs = []
+    for key in sorted(drawings.keys()):
+        bitmaps = drawings[key]
+        pairs.extend((bitmaps[0], pred) for pred in bitmaps)
+    return pairs
+
+
+def benchmark_evaluate(args):
+    pairs = load_drawing_pairs(args.csv, args.image_field, args.draw_events_field, args.bitmap_dim)
+    if args.limit:
+        pairs = pairs[:args.limit]
+
+    reference, reference_time = time_call(lambda: [reference_evaluate(t, p) for (t, p) in pairs])
+    current, current_time = time_call(lambda: [evaluate.evaluate(t, p) for (t, p) in pairs])
+
+    mismatches = sum(1 for (a, b) in zip(reference, current) if a != b)
+    report("evaluate", reference_time, current_time, len(pairs))
+    print "  mismatches: %d" % mismatches
+    return mismatches == 0
+
+
+def load_aligned_rows(aligned_files, sequence_type, bitmap_dim):
+    # (sentences, actions) pairs from seq2seq files, with the " | " alignment markers removed
+    rows = []
+    for aligned_file in aligned_files:
+        with open(aligned_file) as fin:
+            for line in fin:
+                (commands, actions) = line.rstrip("\n").split("\t")
+                sentences = align.split_sentences(commands.replace(" | ", " . "))
+                rows.append((sentences, align.get_event_sequence(actions.replace(" | ", " "), sequence_type, bitmap_dim)))
+    return rows
+
+
+def benchmark_align(args):
+    rows = load_aligned_rows(args.aligned_data, args.sequence_type, args.bitmap_dim)
+    if args.limit:
+        rows = rows[:args.limit]
+    total_actions = lambda actions: actions.count(["BLOCK"]) + 1 if args.sequence_type == "cursor" else len(actions)
+
+    def reference_segmentations():
+        paths = []
+        for (sentences, actions) in rows:
+            reference_find_segmentations(sentences, [], paths, total_actions(actions))
+        return paths
+
+    def current_segmentations():
+        paths = []
+        for (sentences, actions) in rows:
+            features = [align.sentence_features(sentence) for sentence in sentences]
+            align.find_segmentations(sentences, [], paths, total_actions(actions), features)
+        return paths
+
+    # sentence features alone: the same exhaustive search, with features recomputed per call or computed once
+    reference, reference_time = time_call(reference_segmentations)
+    current, current_time = time_call(current_segmentations)
+    report("find_segmentations", reference_time, current_time, len(rows))
+    mismatches = 0 if reference == current else 1
+    print "  mismatches: %d" % mismatches
+
+    reference, reference_time = time_call(lambda: [reference_heuristic_align(s, a, args.sequence_type) for (s, a) in rows])
+    current, current_time = time_call(lambda: [align.heuristic_align(s, a, args.sequence_type) for (s, a) in rows])
+    alignment_mismatches = sum(1 for (a, b) in zip(reference, current) if a != b)
+    report("heuristic_align", reference_time, current_time, len(rows))
+    print "  mismatches: %d" % alignment_mismatches
+    return mismatches + alignment_mismatches == 0
+
+
+def load_description_lines(csv_files, description_fields):
+    # every line of every description, split the way create_dataset.py and the HTML report split them
+    lines = []
+    for csv_file in csv_files:
+        with open(csv_file) as fin:
+            reader = csv.reader(fin)
+            header = next(reader)
+            fields = [header.index(field) for field in description_fields if field in header]
+            for row in reader:
+                for idx in fields:
+                    for line in row[idx].replace("\r", "").replace("\n", "</br>").split("</br>"):
+                        lines.append(line.strip())
+    return lines
+
+
+def benchmark_tokenize(args):
+    lines = load_description_lines(args.description_csv, args.description_field)
+    if args.limit:
+        lines = lines[:args.limit]
+    tokenizer = TreebankWordTokenizer()
+
+    reference, reference_time = time_call(lambda: [reference_tokenize(line) for line in lines])
+    current, current_time = time_call(lambda: [tokenizer.tokenize(line) for line in lines])
+    mismatches = sum(1 for (a, b) in zip(reference, current) if a != b)
+    report("tokenize", reference_time, current_time, len(lines))
+    print "  mismatches: %d" % mismatches
+
+    # a cold cache, as create_dataset.py sees it
+    batch, batch_time = time_call(lambda: TreebankWordTokenizer().tokenize_batch(lines))
+    batch_mismatches = sum(1 for (a, b) in zip(reference, batch) if a != b)
+    report("tokenize_batch (%d distinct lines)" % len(set(lines)), reference_time, batch_time, len(lines))
+    print "  mismatches: %d" % batch_mismatches
+    return mismatches + batch_mismatches == 0
+
+
+if __name__ == "__main__":
+    tasks = {"evaluate": benchmark_evaluate, "align": benchmark_align, "tokenize": benchmark_tokenize}
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-task", type=str, required=True, help="Benchmark to run: one of %s" % ", ".join(sorted(tasks.keys())))
+    parser.add_argument("-csv", type=str, nargs="+", default=["../../mturk/drawing_task/Batch_2126473_batch_results.csv",
+                                                               "../../mturk/drawing_task/sample_task2_results.csv"],
+                        help="CSV files with results from the drawing task")
+    parser.add_argument("-image_field", type=str, default="Input.Image_url", help="Name of CSV field containing image URL")
+    parser.add_argument("-draw_events_field", type=str, default="Answer.WritingTexts", help="Name of CSV field containing drawing task events")
+    parser.add_argument("-aligned_data", type=str, nargs="+", default=["../../data/Batch_2128112/Batch_2128112.seq2seq.rel.aligned.%s" % split
+                                                                       for split in ["train", "val", "test"]],
+                        help="seq2seq files with relative actions and sentences, for the align task")
+    parser.add_argument("-sequence_type", type=str, default="relative", help="Sequence type to align in the align task: relative, absolute or cursor")
+    parser.add_argument("-description_csv", type=str, nargs="+", default=sorted(glob.glob("../../mturk/get_descriptions_of_blocks/*/*.csv")),
+                        help="CSV files with descriptions of block images, for the tokenize task")
+    parser.add_argument("-description_field", type=str, nargs="+", default=["Answer.TranscriptionTexts", "commands"],
+                        help="Names of CSV fields containing descriptions (files without them are skipped)")
+    parser.add_argument("-bitmap_dim", type=int, default=25, help="Width of bitmap in blocks (assumed square)")
+    parser.add_argument("-limit", type=int, default=0, help="Only benchmark the first N items (0 = all)")
+    args = parser.parse_args()
+
+    if args.task not in tasks:
+        parser.print_help()
+        raise ValueError("Unknown benchmark task: {}".format(args.task))
+    if not tasks[args.task](args):
+        raise SystemExit("Benchmark outputs differ from the reference implementation")
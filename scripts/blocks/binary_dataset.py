@@ -0,0 +1,215 @@
+'''
+Reads and writes datasets in a compact binary format, as an alternative to the JSON written by create_dataset.py. A
+dataset is a directory of .npy files that are memory-mapped when read, so example i can be loaded without reading the
+rest of the dataset:
+  <bitmap field>.bits.npy, .offsets.npy, .shapes.npy   bitmaps packed 8 cells to a byte with np.packbits
+  <action field>.ops.npy, .coords.npy, .offsets.npy    action strings as opcode and coordinate arrays (see events.py)
+  <field>.state.npy                                    whether each example has the field, and whether it is null
+  text.jsonl, text.offsets.npy                         every other field, one JSON object per example
+  meta.json                                            the number of examples and the fields stored
+Run python binary_dataset.py -h to convert a JSON dataset.
+'''
+import argparse
+import json
+import os
+import numpy as np
+from events import EventSequence, op_codes, op_has_coords, op_dtype, coord_dtype, to_arrays
+from utils import iter_json_objects
+
+bitmap_fields = ["bitmap.orig_generated", "bitmap.from_mturk", "bitmap.normalized"]
+action_fields = ["actions.absolute", "actions.relative", "actions.cursor", "actions.absolute.normalized"]
+format_version = 1
+
+# values of <field>.state.npy
+MISSING, NULL, PRESENT = range(3)
+
+
+def encode_actions(actions_str):
+    # opcode and coordinate arrays for a space-separated action string such as "START PUT 0 1"
+    tokens = actions_str.split()
+    ops = []
+    coords = []
+    i = 0
+    while i < len(tokens):
+        code = op_codes[tokens[i]]
+        ops.append(code)
+        if op_has_coords[code]:
+            coords.append((int(tokens[i+1]), int(tokens[i+2])))
+            i += 3
+        else:
+            coords.append((0, 0))
+            i += 1
+    return to_arrays(ops, coords)
+
+
+def decode_actions(ops, coords):
+    return str(EventSequence.from_arrays(ops, coords))
+
+
+def encode_bitmap(rows):
+    # the lists of digit strings create_dataset.bitmap_to_list makes, packed into bytes
+    cells = str("".join(rows))
+    if cells.strip("01"):
+        raise ValueError("Only 0/1 bitmaps can be stored in the binary format")
+    shape = (len(rows), len(rows[0]) if rows else 0)
+    return np.packbits(np.frombuffer(cells, dtype=np.uint8) - ord("0")), shape
+
+
+def decode_bitmap(bits, shape):
+    (rows, cols) = shape
+    return np.unpackbits(bits)[:rows * cols].reshape(rows, cols).astype(np.int32)
+
+
+class BinaryDatasetWriter(object):
+    '''
+    Writes dataset objects (as built by create_dataset.build_example) to a binary dataset directory, one at a time.
+    The text fields are written as they arrive; the arrays are written by close().
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.text_file = open(os.path.join(path, "text.jsonl"), "w")
+        self.text_offsets = [0]
+        self.states = dict((field, []) for field in bitmap_fields + action_fields)
+        self.bitmaps = dict((field, ([], [])) for field in bitmap_fields)
+        self.actions = dict((field, ([], [])) for field in action_fields)
+        self.count = 0
+
+    def write(self, obj):
+        text = {}
+        for (key, value) in obj.iteritems():
+            if key not in self.states:
+                text[key] = value
+        self.text_file.write(json.dumps(text, sort_keys=True) + "\n")
+        self.text_offsets.append(self.text_file.tell())
+
+        for field in bitmap_fields + action_fields:
+            value = obj.get(field)
+            self.states[field].append(MISSING if field not in obj else NULL if value is None else PRESENT)
+            if value is None:
+                continue
+            if field in self.bitmaps:
+                (bits, shape) = encode_bitmap(value)
+                self.bitmaps[field][0].append(bits)
+                self.bitmaps[field][1].append(shape)
+            else:
+                (ops, coords) = encode_actions(value)
+                assert decode_actions(ops, coords) == value, "{} of example {} is not a canonical action string".format(field, self.count)
+                self.actions[field][0].append(ops)
+                self.actions[field][1].append(coords)
+        self.count += 1
+
+    def save(self, name, array):
+        np.save(os.path.join(self.path, name + ".npy"), array)
+
+    def close(self):
+        self.text_file.close()
+        self.save("text.offsets", np.array(self.text_offsets, dtype=np.int64))
+        for field in bitmap_fields + action_fields:
+            states = np.array(self.states[field], dtype=np.int8)
+            self.save(field + ".state", states)
+            # offsets and shapes have an entry for every example, so that example i is found without a search
+            present = (states == PRESENT)
+            if field in self.bitmaps:
+                (bits, shapes) = self.bitmaps[field]
+                sizes = np.zeros(self.count, dtype=np.int64)
+                sizes[present] = [len(b) for b in bits]
+                all_shapes = np.zeros((self.count, 2), dtype=np.int32)
+                all_shapes[present] = np.array(shapes, dtype=np.int32).reshape(-1, 2)
+                self.save(field + ".bits", np.concatenate(bits) if bits else np.zeros(0, dtype=np.uint8))
+                self.save(field + ".shapes", all_shapes)
+            else:
+                (ops, coords) = self.actions[field]
+                sizes = np.zeros(self.count, dtype=np.int64)
+                sizes[present] = [len(o) for o in ops]
+                self.save(field + ".ops", np.concatenate(ops) if ops else np.zeros(0, dtype=op_dtype))
+                self.save(field + ".coords", np.concatenate(coords) if coords else np.zeros((0, 2), dtype=coord_dtype))
+            self.save(field + ".offsets", np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64))
+
+        with open(os.path.join(self.path, "meta.json"), "w") as fout:
+            json.dump({"version": format_version, "num_examples": self.count, "bitmap_fields": bitmap_fields,
+                       "action_fields": action_fields}, fout, indent=4, sort_keys=True)
+
+
+class BinaryDataset(object):
+    '''
+    Random access to the examples of a binary dataset directory. dataset[i] is the same object the JSON dataset
+    holds for example i; bitmap() and actions() return a single field as arrays instead.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as fin:
+            self.meta = json.load(fin)
+        self.arrays = {}
+        self.text_file = open(os.path.join(path, "text.jsonl"))
+
+    def array(self, name):
+        if name not in self.arrays:
+            self.arrays[name] = np.load(os.path.join(self.path, name + ".npy"), mmap_mode="r")
+        return self.arrays[name]
+
+    def __len__(self):
+        return self.meta["num_examples"]
+
+    def check_index(self, i):
+        if not 0 <= i < len(self):
+            raise IndexError("example {} is out of range for a dataset of {} examples".format(i, len(self)))
+
+    def state(self, i, field):
+        return self.array(field + ".state")[i]
+
+    def bitmap(self, i, field):
+        # the bitmap as an int32 array, or None if the example has none
+        self.check_index(i)
+        if self.state(i, field) != PRESENT:
+            return None
+        offsets = self.array(field + ".offsets")
+        return decode_bitmap(self.array(field + ".bits")[offsets[i]:offsets[i+1]], self.array(field + ".shapes")[i])
+
+    def actions(self, i, field):
+        # the opcode and coordinate arrays of the actions, or None if the example has none
+        self.check_index(i)
+        if self.state(i, field) != PRESENT:
+            return None
+        offsets = self.array(field + ".offsets")
+        return (np.asarray(self.array(field + ".ops")[offsets[i]:offsets[i+1]]),
+                np.asarray(self.array(field + ".coords")[offsets[i]:offsets[i+1]]))
+
+    def __getitem__(self, i):
+        self.check_index(i)
+        self.text_file.seek(self.array("text.offsets")[i])
+        obj = json.loads(self.text_file.readline())
+        for field in self.meta["bitmap_fields"]:
+            state = self.state(i, field)
+            if state != MISSING:
+                bitmap = self.bitmap(i, field)
+                obj[field] = ["".join(str(v) for v in row) for row in bitmap.tolist()] if bitmap is not None else None
+        for field in self.meta["action_fields"]:
+            state = self.state(i, field)
+            if state != MISSING:
+                actions = self.actions(i, field)
+                obj[field] = decode_actions(*actions) if actions is not None else None
+        return obj
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def close(self):
+        self.text_file.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-json", type=str, required=True, help="Input dataset JSON file (a JSON array or one object per line)")
+    parser.add_argument("-output_dir", type=str, required=True, help="Directory to write the binary dataset to")
+    args = parser.parse_args()
+
+    writer = BinaryDatasetWriter(args.output_dir)
+    for obj in iter_json_objects(args.json):
+        writer.write(obj)
+    writer.close()
+    print "Wrote %d examples to %s" % (writer.count, args.output_dir)
@@ -1,4 +1,6 @@
+import binascii
 import numpy as np
+from events import AbsoluteEventSequence, ADD, DEL
 
 class BitmapMaker(object):
     bitmap = None
@@ -32,3 +34,185 @@ class BitmapMaker(object):
         commands = [s.strip().split() for s in commands_str.replace("\r","").split("\n")]
         self.process_commands(commands)
 
+
+
+def render_batch(sequences, dims):
+    '''
+    Renders many absolute event sequences (AbsoluteEventSequence objects or lists of ["ADD"/"DEL", row, col] events) in
+    one vectorized pass. Returns an (N, rows, cols) int32 array of bitmaps, and a boolean mask of the sequences that
+    had events outside the grid. Those events are skipped instead of raising or wrapping around.
+    '''
+    (rows, cols) = dims
+    sequences = [s if isinstance(s, AbsoluteEventSequence) else AbsoluteEventSequence(s) for s in sequences]
+    num_sequences = len(sequences)
+    bitmaps = np.zeros(num_sequences * rows * cols, dtype=np.int32)
+    out_of_range = np.zeros(num_sequences, dtype=bool)
+    if num_sequences == 0 or sum(len(s) for s in sequences) == 0:
+        return bitmaps.reshape(num_sequences, rows, cols), out_of_range
+
+    ops = np.concatenate([s.ops for s in sequences])
+    coords = np.concatenate([s.coords for s in sequences]).astype(np.int_)
+    sequence_ids = np.repeat(np.arange(num_sequences), [len(s) for s in sequences])
+    assert np.all((ops == ADD) | (ops == DEL)), "commands must be ADD or DEL"
+
+    inside = (coords[:, 0] >= 0) & (coords[:, 0] < rows) & (coords[:, 1] >= 0) & (coords[:, 1] < cols)
+    out_of_range[sequence_ids[~inside]] = True
+    (ops, coords, sequence_ids) = (ops[inside], coords[inside], sequence_ids[inside])
+
+    # the last event on a cell decides its value, so only the last occurrence of each cell is written
+    cells = (sequence_ids * rows + coords[:, 0]) * cols + coords[:, 1]
+    (unique_cells, first_from_end) = np.unique(cells[::-1], return_index=True)
+    last = len(cells) - 1 - first_from_end
+    bitmaps[cells[last]] = (ops[last] == ADD)
+    return bitmaps.reshape(num_sequences, rows, cols), out_of_range
+
+
+class PackedBitmap(object):
+    '''
+    A 0/1 grid packed into one Python integer, one bit per cell in row-major order with cell (0,0) as the most
+    significant bit (the same bit order as np.packbits). Hashable, and roughly 30x smaller than an int32 array.
+    '''
+    __slots__ = ("bits", "rows", "cols")
+
+    def __init__(self, bits, rows, cols):
+        self.bits = bits
+        self.rows = rows
+        self.cols = cols
+
+    @classmethod
+    def from_array(cls, bitmap):
+        bitmap = np.asarray(bitmap)
+        (rows, cols) = bitmap.shape
+        size = rows * cols
+        if size == 0:
+            return cls(0, rows, cols)
+        packed = np.packbits((bitmap == 1).ravel())
+        # packbits pads the last byte with zeros on the right
+        bits = int(binascii.hexlify(packed.tobytes()), 16) >> (8 * len(packed) - size)
+        return cls(bits, rows, cols)
+
+    def to_array(self, dtype=np.int32):
+        size = self.rows * self.cols
+        if size == 0:
+            return np.zeros((self.rows, self.cols), dtype=dtype)
+        num_bytes = (size + 7) // 8
+        padded = self.bits << (8 * num_bytes - size)
+        packed = np.frombuffer(binascii.unhexlify("%0*x" % (2 * num_bytes, padded)), dtype=np.uint8)
+        return np.unpackbits(packed)[:size].reshape(self.rows, self.cols).astype(dtype)
+
+    def shape(self):
+        return (self.rows, self.cols)
+
+    def count(self):
+        return bin(self.bits).count("1")
+
+    def hamming_distance(self, other):
+        assert self.shape() == other.shape(), "cannot compare bitmaps of shape {} and {}".format(self.shape(), other.shape())
+        return bin(self.bits ^ other.bits).count("1")
+
+    def shift(self, xdiff=0, ydiff=0):
+        '''
+        Moves every block at (i, j) to (i - xdiff, j - ydiff), like evaluate.translate. Returns the shifted bitmap and
+        the number of blocks that moved off the grid.
+        '''
+        if xdiff == 0 and ydiff == 0:
+            return self, 0
+        (xdiff, ydiff) = (int(xdiff), int(ydiff))
+        (rows, cols) = (self.rows, self.cols)
+        # columns whose blocks stay on the grid after the horizontal move, repeated for every row
+        first_col = min(max(ydiff, 0), cols)
+        last_col = max(min(cols + ydiff, cols), 0)
+        row_mask = ((1 << (last_col - first_col)) - 1) << (cols - last_col)
+        repeat = sum(1 << (i * cols) for i in range(rows))
+        kept = self.bits & (row_mask * repeat)
+
+        offset = xdiff * cols + ydiff
+        moved = kept << offset if offset >= 0 else kept >> -offset
+        shifted = PackedBitmap(moved & ((1 << (rows * cols)) - 1), rows, cols)
+        return shifted, self.count() - shifted.count()
+
+    def __eq__(self, other):
+        return isinstance(other, PackedBitmap) and (self.bits, self.rows, self.cols) == (other.bits, other.rows, other.cols)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.bits, self.rows, self.cols))
+
+    def __repr__(self):
+        return "PackedBitmap({:#x}, {}, {})".format(self.bits, self.rows, self.cols)
+
+
+class SparseBitmap(object):
+    '''
+    The blocks of a board with no fixed size, stored as a sorted (n, 2) array of distinct (row, col) coordinates.
+    Coordinates may be negative or arbitrarily large, so sequences that wander off a fixed grid keep all of their
+    blocks, and every operation costs O(blocks) rather than O(grid area).
+    '''
+    __slots__ = ("cells",)
+
+    def __init__(self, cells=()):
+        cells = np.asarray(cells, dtype=np.int_).reshape(-1, 2)
+        self.cells = np.unique(cells, axis=0) if len(cells) > 1 else cells
+
+    @classmethod
+    def from_events(cls, sequence):
+        '''
+        Applies an absolute event sequence (an AbsoluteEventSequence or a list of ["ADD"/"DEL", row, col] events) to an
+        empty board. As in BitmapMaker, the last event on a cell decides whether it holds a block.
+        '''
+        if not isinstance(sequence, AbsoluteEventSequence):
+            sequence = AbsoluteEventSequence(sequence)
+        (ops, coords) = (sequence.ops, sequence.coords.astype(np.int_))
+        if len(ops) == 0:
+            return cls()
+        assert np.all((ops == ADD) | (ops == DEL)), "commands must be ADD or DEL"
+        (cells, first_from_end) = np.unique(coords[::-1], axis=0, return_index=True)
+        return cls(cells[ops[len(ops) - 1 - first_from_end] == ADD])
+
+    @classmethod
+    def from_array(cls, bitmap):
+        return cls(np.argwhere(np.asarray(bitmap) == 1))
+
+    def to_array(self, dims, dtype=np.int32):
+        '''
+        Draws the blocks on a dense rows x cols grid. Returns the grid and the number of blocks that fell outside it.
+        '''
+        (rows, cols) = dims
+        bitmap = np.zeros((rows, cols), dtype=dtype)
+        inside = (self.cells[:, 0] >= 0) & (self.cells[:, 0] < rows) & (self.cells[:, 1] >= 0) & (self.cells[:, 1] < cols)
+        bitmap[self.cells[inside, 0], self.cells[inside, 1]] = 1
+        return bitmap, int(np.count_nonzero(~inside))
+
+    def count(self):
+        return len(self.cells)
+
+    def corner(self):
+        # the topmost row and leftmost column holding a block, like evaluate.find_corner on a dense grid
+        if len(self.cells) == 0:
+            return (-1, -1)
+        return tuple(int(v) for v in self.cells.min(axis=0))
+
+    def hamming_distance(self, other):
+        # blocks in exactly one of the two boards: |A| + |B| - 2 |A & B|, where |A | B| comes from one np.unique
+        if self.count() == 0 or other.count() == 0:
+            return self.count() + other.count()
+        union = len(np.unique(np.concatenate([self.cells, other.cells]), axis=0))
+        return 2 * union - self.count() - other.count()
+
+    def shift(self, xdiff=0, ydiff=0):
+        # moves every block at (i, j) to (i - xdiff, j - ydiff); nothing can fall off an unbounded board
+        return SparseBitmap(self.cells - np.array([xdiff, ydiff], dtype=np.int_))
+
+    def __eq__(self, other):
+        return isinstance(other, SparseBitmap) and np.array_equal(self.cells, other.cells)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.cells.tobytes())
+
+    def __repr__(self):
+        return "SparseBitmap({})".format(self.cells.tolist())
@@ -10,16 +10,25 @@ import random
 import itertools
 from treebank_tokenizer import TreebankWordTokenizer
 from events import AbsoluteEventSequence, RelativeEventSequence, CursorEventSequence
-from bitmap import BitmapMaker
-from utils import read_csv
-from align import align_strings
+from bitmap import render_batch
+from utils import read_csv, json_formats, JsonObjectWriter
+from binary_dataset import BinaryDatasetWriter
+from align import align_strings, split_sentences, sentence_features, AlignmentCache, default_cache_bytes
 import urllib2
+import hashlib
+import threading
+import time
 from io import StringIO
 from collections import defaultdict
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import json
 
 gif_pattern = r'(img_[0-9]+)\.gif'
+build_stages = ["tokenize", "convert", "align", "render"]
+# per-process state of the build workers, set up by init_build_worker
+build_state = {}
 
 def image_url_to_key(url):
     image_key = re.search(gif_pattern, url).group(1)
@@ -33,6 +42,62 @@ def retrieve_bitmap(url):
     #txtio = StringIO(response.read())
     return np.loadtxt(response)
 
+class BitmapFetcher(object):
+    '''
+    Fetches the true bitmaps of the images in a dataset, once per distinct URL. Downloads are stored in cache_dir under
+    the SHA-1 of their URL, so rebuilding a dataset does not download them again; cache_dir is created on the first
+    download. If image_dir is given, nothing is downloaded: img_NNNN.txt is read from that generate_images output
+    directory instead.
+    '''
+
+    def __init__(self, cache_dir=None, image_dir=None, threads=8):
+        self.cache_dir = cache_dir
+        self.image_dir = image_dir
+        self.threads = threads
+        self.bitmaps = {}
+
+    def cache_path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha1(url).hexdigest() + ".txt")
+
+    def load(self, url):
+        if self.image_dir:
+            return np.loadtxt(os.path.join(self.image_dir, os.path.basename(url)))
+        if not self.cache_dir:
+            return retrieve_bitmap(url)
+        path = self.cache_path(url)
+        if not os.path.exists(path):
+            data = urllib2.urlopen(url).read()
+            # the cache directory is only made once something is downloaded; other threads may be making it too
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                if not os.path.isdir(self.cache_dir):
+                    raise
+            # write under a temporary name first so that an interrupted download never ends up in the cache
+            tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.current_thread().ident)
+            with open(tmp_path, "wb") as fout:
+                fout.write(data)
+            os.rename(tmp_path, path)
+        return np.loadtxt(path)
+
+    def prefetch(self, urls):
+        # fetch the distinct URLs that have not been fetched yet, several at a time
+        urls = sorted(set(urls) - set(self.bitmaps))
+        if not urls:
+            return
+        pool = ThreadPool(min(self.threads, len(urls)))
+        try:
+            for (url, bitmap) in zip(urls, pool.map(self.load, urls)):
+                self.bitmaps[url] = bitmap
+        finally:
+            pool.close()
+            pool.join()
+
+    def get(self, url):
+        if url not in self.bitmaps:
+            self.bitmaps[url] = self.load(url)
+        return self.bitmaps[url]
+
 def bitmap_to_list(b):
     if b is not None:
         bl = b.tolist()
@@ -48,7 +113,7 @@ def tokenize_description(tokenizer, text):
             return line
 
     lines = text.split("</br>")
-    tok_lines = [" ".join(tokenizer.tokenize(l)).lower() for l in lines]
+    tok_lines = [" ".join(tokens).lower() for tokens in tokenizer.tokenize_batch(lines)]
     punct_tok_lines = [add_punct(l) for l in tok_lines if l.strip()]
     return " ".join(punct_tok_lines)
 
@@ -82,86 +147,261 @@ def split_keys(rows, image_idx, train_ratio, test_ratio, val_ratio):
 
     return attrs
 
-def write_data(rows, key_attrs, image_idx, commands_idx, actions_idx, output_file, include_bitmaps=True, grid_dims=(25,25)):
-    tokenizer = TreebankWordTokenizer()
-    bmpmaker = BitmapMaker(grid_dims[0],grid_dims[1])
+class CacheRecorder(object):
+    '''
+    A build worker's view of the parent's AlignmentCache. Lookups read the cache file directly, and hits and new
+    results are recorded so that the parent can apply them with apply_cache_updates; only the parent writes the file.
+    '''
+
+    def __init__(self, path):
+        self.cache = AlignmentCache(path, read_only=True)
+        self.updates = []
+
+    def get(self, key):
+        result = self.cache.get(key)
+        if result is not None:
+            self.updates.append((key, None))
+        return result
+
+    def put(self, key, result):
+        self.updates.append((key, result))
 
-    with open(output_file, "w") as fout:
-        objs = []
-        for i,row in enumerate(rows):
+    def pop_updates(self):
+        (updates, self.updates) = (self.updates, [])
+        return updates
 
+
+def apply_cache_updates(cache, updates):
+    for (key, result) in updates:
+        if result is None:
+            cache.touch(key)
+        else:
+            cache.misses += 1
+            cache.put(key, result)
+
+
+def build_example(i, image_url, description, actions, bitmap, tokenizer, key_attrs, grid_dims=(25,25), align_cache=None):
+    '''
+    Builds the dataset object for one row of the drawing task results. Returns the object and the seconds spent in each
+    of the build_stages.
+    '''
+    timings = {}
+    start = time.time()
+    image_key = image_url_to_key(image_url)
+    commands = tokenize_description(tokenizer, description)
+    timings["tokenize"] = time.time() - start
+
+    start = time.time()
+    abs_seq = AbsoluteEventSequence.from_mturk_string(actions, canonicalize=True)
+    rel_seq = RelativeEventSequence.from_absolute(abs_seq)
+    cur_seq = CursorEventSequence.from_absolute(abs_seq)
+
+    abs_str = str(abs_seq)
+    rel_str = str(rel_seq)
+    cur_str = str(cur_seq)
+
+    raw_txt = actions.replace("\r", "").replace("\n"," ")
+    timings["convert"] = time.time() - start
+
+    start = time.time()
+    features = [sentence_features(sentence) for sentence in split_sentences(commands)]
+    rel_alignments,rel_align_info = align_strings(commands, rel_str, "relative", "clever", grid_dims[0], backup_using_naive=True, cache=align_cache, features=features)
+    abs_alignments,abs_align_info = align_strings(commands, abs_str, "absolute", "clever", grid_dims[0], backup_using_naive=True, cache=align_cache, features=features)
+
+    join_list_of_lists = lambda l: " ".join(str(i) for i in itertools.chain(*l))
+    str_rel_alignments = [(c,join_list_of_lists(r)) for c,r in rel_alignments]
+    str_abs_alignments = [(c,join_list_of_lists(r)) for c,r in abs_alignments]
+    timings["align"] = time.time() - start
+
+    obj = {}
+    obj["image_url"] = image_url
+    obj["image_id"] = image_key
+    obj["sample_id"] = i
+    obj["commands"] = commands
+    obj["actions.absolute"] = abs_str
+    obj["actions.relative"] = rel_str
+    obj["actions.cursor"] = cur_str
+    obj["alignments.relative"] = str_rel_alignments
+    obj["alignments.relative.info"] = rel_align_info
+    obj["alignments.absolute"] = str_abs_alignments
+    obj["alignments.absolute.info"] = abs_align_info
+
+    for key,val in key_attrs[image_key].iteritems():
+        obj[key] = val
+
+    start = time.time()
+    if bitmap is not None:
+        abs_norm_seq = AbsoluteEventSequence.from_relative(rel_seq, grid_dims[0], grid_dims[1])
+
+        # sequences that leave the grid get no bitmap
+        bitmaps, off_grid = render_batch([abs_norm_seq, abs_seq], grid_dims)
+        bitmap_mturk_norm = bitmaps[0] if not off_grid[0] else None
+        bitmap_mturk = bitmaps[1] if not off_grid[1] else None
+
+        obj["actions.absolute.normalized"] = str(abs_norm_seq)
+        obj["bitmap.orig_generated"] = bitmap_to_list(bitmap.astype(np.int_))
+        obj["bitmap.from_mturk"] = bitmap_to_list(bitmap_mturk)
+        obj["bitmap.normalized"] = bitmap_to_list(bitmap_mturk_norm)
+    timings["render"] = time.time() - start
+    return obj, timings
+
+
+def init_build_worker(key_attrs, grid_dims, align_cache_path):
+    build_state["tokenizer"] = TreebankWordTokenizer()
+    build_state["key_attrs"] = key_attrs
+    build_state["grid_dims"] = grid_dims
+    build_state["align_cache"] = CacheRecorder(align_cache_path) if align_cache_path else None
+
+
+def build_example_in_worker(task):
+    align_cache = build_state["align_cache"]
+    (obj, timings) = build_example(*task, tokenizer=build_state["tokenizer"], key_attrs=build_state["key_attrs"],
+                                   grid_dims=build_state["grid_dims"], align_cache=align_cache)
+    return obj, timings, align_cache.pop_updates() if align_cache is not None else []
+
+
+def write_data(rows, key_attrs, image_idx, commands_idx, actions_idx, output_file, include_bitmaps=True, grid_dims=(25,25), align_cache=None, bitmap_fetcher=None, output_format="json", workers=1, first_sample_id=0, append=False):
+    '''
+    Builds an example from every row and writes them to output_file in row order, numbered from first_sample_id. With
+    workers > 1 the examples are built in a pool of processes, each with its own tokenizer. Prints how long each stage
+    of the build took. With append=True (JSON lines only) the examples are added to the end of output_file. Returns the
+    byte offset of every example in output_file (its index, for the binary format, where output_file is a directory).
+    '''
+    assert output_format == "jsonl" or not append, "only JSON lines output can be appended to"
+    timings = dict((stage, 0.0) for stage in build_stages)
+    start = time.time()
+    if include_bitmaps:
+        if bitmap_fetcher is None:
+            bitmap_fetcher = BitmapFetcher()
+        bitmap_fetcher.prefetch([image_url_to_text_bitmap_url(row[image_idx]) for row in rows])
+    timings["fetch"] = time.time() - start
+
+    tasks = ((first_sample_id + i, row[image_idx], row[commands_idx], row[actions_idx],
+              bitmap_fetcher.get(image_url_to_text_bitmap_url(row[image_idx])) if include_bitmaps else None)
+             for (i, row) in enumerate(rows))
+    pool = None
+    if workers <= 1:
+        tokenizer = TreebankWordTokenizer()
+        results = (build_example(*task, tokenizer=tokenizer, key_attrs=key_attrs, grid_dims=grid_dims, align_cache=align_cache) + ([],)
+                   for task in tasks)
+    else:
+        if align_cache is not None:
+            # let the workers see everything cached so far
+            align_cache.connection.commit()
+        pool = Pool(workers, initializer=init_build_worker,
+                    initargs=(key_attrs, grid_dims, align_cache.path if align_cache is not None else None))
+        results = pool.imap(build_example_in_worker, tasks, chunksize=16)
+
+    start = time.time()
+    offsets = []
+    fout = None
+    try:
+        if output_format == "binary":
+            writer = BinaryDatasetWriter(output_file)
+        else:
+            fout = open(output_file, "a" if append else "w")
+            fout.seek(0, os.SEEK_END)
+            writer = JsonObjectWriter(fout, output_format)
+        for (i, (obj, row_timings, cache_updates)) in enumerate(results):
             if i % 100 == 0:
                 print "  {}  ".format(i)
+            if cache_updates:
+                apply_cache_updates(align_cache, cache_updates)
+            for (stage, seconds) in row_timings.iteritems():
+                timings[stage] += seconds
+            offsets.append(fout.tell() if fout is not None else writer.count)
+            writer.write(obj)
+        writer.close()
+    finally:
+        if fout is not None:
+            fout.close()
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    print "Created dataset at %s" % output_file
+    print "Build time: %.1fs for %d rows with %d worker(s); fetching bitmaps took %.1fs" % (time.time() - start, len(rows), max(workers, 1), timings["fetch"])
+    print "  time per stage, summed over workers: " + ", ".join("%s %.1fs" % (stage, timings[stage]) for stage in build_stages)
+    return offsets
+
+
+class BuildManifest(object):
+    '''
+    Records what incremental builds have written to a JSON lines dataset: the sample_id and byte offset of the example
+    built from each AssignmentId, the attributes (data split) of each image, and the size of the output file when the
+    manifest was saved. Anything past that size was written by a build that did not finish, and is discarded. loaded
+    says whether the manifest was read from path or is new.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.assignments = {}
+        self.key_attrs = {}
+        self.output_bytes = 0
+        self.loaded = os.path.exists(path)
+        if self.loaded:
+            with open(path) as fin:
+                manifest = json.load(fin)
+            self.assignments = manifest["assignments"]
+            self.key_attrs = manifest["key_attrs"]
+            self.output_bytes = manifest["output_bytes"]
+
+    def num_examples(self):
+        return len(self.assignments)
+
+    def add(self, assignment_ids, offsets):
+        first_sample_id = self.num_examples()
+        for (i, (assignment_id, offset)) in enumerate(zip(assignment_ids, offsets)):
+            self.assignments[assignment_id] = [first_sample_id + i, offset]
+
+    def save(self):
+        # write the new manifest next to the old one and swap them, so that a crash leaves one of the two intact
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as fout:
+            json.dump({"assignments": self.assignments, "key_attrs": self.key_attrs, "output_bytes": self.output_bytes},
+                      fout, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+
+def update_data(rows, manifest, assignment_idx, image_idx, commands_idx, actions_idx, output_file, train_ratio, test_ratio, val_ratio, **kwargs):
+    '''
+    Incremental version of write_data: appends examples only for the rows whose AssignmentId is not in the manifest.
+    Images seen by earlier builds keep their data split; new images are split with split_keys. Other keyword arguments
+    are passed on to write_data.
+    '''
+    if os.path.exists(output_file):
+        output_bytes = os.path.getsize(output_file)
+        # without a manifest there is no telling which examples the output holds, so it is left alone
+        if not manifest.loaded and output_bytes > 0:
+            raise Exception("{} exists, but there is no manifest of its examples at {}; build it again without "
+                            "-incremental, or give the right -manifest".format(output_file, manifest.path))
+        if output_bytes < manifest.output_bytes:
+            raise Exception("{} is {} bytes, but the manifest {} says {} bytes were written; it has been replaced or "
+                            "changed since".format(output_file, output_bytes, manifest.path, manifest.output_bytes))
+        with open(output_file, "r+b") as fout:
+            fout.truncate(manifest.output_bytes)
+    elif manifest.output_bytes:
+        raise Exception("The manifest {} lists examples, but {} does not exist".format(manifest.path, output_file))
+
+    new_rows = []
+    new_assignment_ids = set()
+    for row in rows:
+        if row[assignment_idx] not in manifest.assignments and row[assignment_idx] not in new_assignment_ids:
+            new_assignment_ids.add(row[assignment_idx])
+            new_rows.append(row)
+    print "{} of {} rows are new".format(len(new_rows), len(rows))
+
+    new_image_rows = [row for row in new_rows if image_url_to_key(row[image_idx]) not in manifest.key_attrs]
+    key_attrs = defaultdict(dict, manifest.key_attrs)
+    if new_image_rows:
+        key_attrs.update(split_keys(new_image_rows, image_idx, train_ratio, test_ratio, val_ratio))
 
-            image_url = row[image_idx]
-            if include_bitmaps:
-                bitmap = retrieve_bitmap(image_url_to_text_bitmap_url(image_url))
-            else:
-                bitmap = None
-            
-            image_key = image_url_to_key(image_url)
-            commands = tokenize_description(tokenizer, row[commands_idx])
-            actions = row[actions_idx]
-
-            abs_seq = AbsoluteEventSequence.from_mturk_string(actions).canonicalize()
-            rel_seq = RelativeEventSequence.from_absolute(abs_seq)
-            cur_seq = CursorEventSequence.from_absolute(abs_seq)
-
-            abs_str = str(abs_seq)
-            rel_str = str(rel_seq)
-            cur_str = str(cur_seq)
-
-            raw_txt = actions.replace("\r", "").replace("\n"," ")
-
-            rel_alignments,rel_align_info = align_strings(commands, rel_str, "relative", "clever", grid_dims[0], backup_using_naive=True)
-            abs_alignments,abs_align_info = align_strings(commands, abs_str, "absolute", "clever", grid_dims[0], backup_using_naive=True)
-
-            join_list_of_lists = lambda l: " ".join(str(i) for i in itertools.chain(*l))
-            str_rel_alignments = [(c,join_list_of_lists(r)) for c,r in rel_alignments]
-            str_abs_alignments = [(c,join_list_of_lists(r)) for c,r in abs_alignments]
-
-            obj = {}
-            obj["image_url"] = image_url
-            obj["image_id"] = image_key
-            obj["sample_id"] = i
-            obj["commands"] = commands  
-            obj["actions.absolute"] = abs_str
-            obj["actions.relative"] = rel_str
-            obj["actions.cursor"] = cur_str
-            obj["alignments.relative"] = str_rel_alignments
-            obj["alignments.relative.info"] = rel_align_info
-            obj["alignments.absolute"] = str_abs_alignments
-            obj["alignments.absolute.info"] = abs_align_info
-
-            for key,val in key_attrs[image_key].iteritems():
-                obj[key] = val
-
-            if bitmap is not None:                
-                abs_norm_seq = AbsoluteEventSequence.from_relative(rel_seq, grid_dims[0], grid_dims[1])
-
-                try:
-                    bmpmaker.clear()
-                    bmpmaker.process_commands(abs_norm_seq.events)
-                    bitmap_mturk_norm = bmpmaker.bitmap.copy()
-                except:
-                    bitmap_mturk_norm = None
-                    
-
-                try:
-                    bmpmaker.clear()
-                    bmpmaker.process_commands(abs_seq.events)                
-                    bitmap_mturk = bmpmaker.bitmap.copy()
-                except:
-                    bitmap_mturk = None
-                
-                obj["actions.absolute.normalized"] = str(abs_norm_seq)
-                obj["bitmap.orig_generated"] = bitmap_to_list(bitmap.astype(np.int_))
-                obj["bitmap.from_mturk"] = bitmap_to_list(bitmap_mturk.astype(np.int_))
-                obj["bitmap.normalized"] = bitmap_to_list(bitmap_mturk_norm)
-            objs.append(obj)
-        json.dump(objs, fout, indent=4, sort_keys=True)
-
-        print "Created dataset at %s" % output_file
+    offsets = write_data(new_rows, key_attrs, image_idx, commands_idx, actions_idx, output_file, output_format="jsonl",
+                         first_sample_id=manifest.num_examples(), append=True, **kwargs)
+    manifest.add([row[assignment_idx] for row in new_rows], offsets)
+    manifest.key_attrs = dict(key_attrs)
+    manifest.output_bytes = os.path.getsize(output_file)
+    manifest.save()
 
 
 if __name__=="__main__":
@@ -179,8 +419,22 @@ if __name__=="__main__":
     parser.add_argument("-image_field", type=str, default="Input.Image_url", help="Name of CSV field containing image URL")
     parser.add_argument("-retrieve_text_bitmaps", type=bool, default=True, help="Retrieve and augment data with bitmaps located adjacent to image URL's")
     parser.add_argument("-draw_events_field", type=str, default="Answer.WritingTexts", help="Name of CSV field containing drawing task events")
+    parser.add_argument("-align_cache", type=str, default="", help="SQLite file to cache alignments in between runs (default: alignments.cache.sqlite next to the output file)")
+    parser.add_argument("-align_cache_mb", type=int, default=default_cache_bytes // (1024 * 1024), help="Size limit of the alignment cache in MB")
+    parser.add_argument("-no_align_cache", action="store_true", help="Align every row again instead of using the alignment cache")
+    parser.add_argument("-bitmap_cache_dir", type=str, default="", help="Directory to keep downloaded bitmaps in (default: bitmaps.cache next to the output file)")
+    parser.add_argument("-image_dir", type=str, default="", help="Read bitmaps from this generate_images output directory instead of downloading them")
+    parser.add_argument("-output_format", type=str, default="", choices=[""] + json_formats + ["binary"], help="Write one JSON array (json), one example per line as it is built (jsonl), or a directory of memory-mapped arrays (binary, see binary_dataset.py). Defaults to json, or jsonl with -incremental")
+    parser.add_argument("-incremental", action="store_true", help="Only build examples for rows that are not in the output yet, and append them to it (JSON lines only)")
+    parser.add_argument("-manifest", type=str, default="", help="Manifest of the rows already in the output, for -incremental (default: the output file name + .manifest.json)")
+    parser.add_argument("-assignment_field", type=str, default="AssignmentId", help="Name of CSV field that identifies a row, for -incremental")
+    parser.add_argument("-workers", type=int, default=1, help="Number of processes to build examples with")
+    parser.add_argument("-fetch_threads", type=int, default=8, help="Number of bitmaps to download at a time")
 
     args = parser.parse_args()
+    if args.incremental and args.output_format in ["json", "binary"]:
+        parser.error("-incremental only works with -output_format jsonl")
+    output_format = args.output_format if args.output_format else ("jsonl" if args.incremental else "json")
 
     random.seed(args.rseed)
 
@@ -190,12 +444,29 @@ if __name__=="__main__":
     actions_idx = header.index(args.draw_events_field)
     image_idx = header.index(args.image_field)
 
-    key_attrs = split_keys(rows, image_idx, args.train_ratio, args.test_ratio, args.val_ratio)
     output_file = args.output_json_file
 
     d = os.path.dirname(output_file)
     if not os.path.exists(d) and len(d)>0:
         os.makedirs(d)
 
+    align_cache = None
+    if not args.no_align_cache:
+        align_cache_file = args.align_cache if args.align_cache else os.path.join(d, "alignments.cache.sqlite")
+        align_cache = AlignmentCache(align_cache_file, args.align_cache_mb * 1024 * 1024)
+
+    bitmap_cache_dir = args.bitmap_cache_dir if args.bitmap_cache_dir else os.path.join(d, "bitmaps.cache")
+    bitmap_fetcher = BitmapFetcher(cache_dir=bitmap_cache_dir, image_dir=args.image_dir, threads=args.fetch_threads)
+
     print "Processing {} rows".format(len(rows))
-    write_data(rows, key_attrs, image_idx, commands_idx, actions_idx, output_file, include_bitmaps=args.retrieve_text_bitmaps)
+    if args.incremental:
+        manifest = BuildManifest(args.manifest if args.manifest else output_file + ".manifest.json")
+        update_data(rows, manifest, header.index(args.assignment_field), image_idx, commands_idx, actions_idx, output_file,
+                    args.train_ratio, args.test_ratio, args.val_ratio, include_bitmaps=args.retrieve_text_bitmaps,
+                    align_cache=align_cache, bitmap_fetcher=bitmap_fetcher, workers=args.workers)
+    else:
+        key_attrs = split_keys(rows, image_idx, args.train_ratio, args.test_ratio, args.val_ratio)
+        write_data(rows, key_attrs, image_idx, commands_idx, actions_idx, output_file, include_bitmaps=args.retrieve_text_bitmaps, align_cache=align_cache, bitmap_fetcher=bitmap_fetcher, output_format=output_format, workers=args.workers)
+    if align_cache is not None:
+        print "Alignment cache: %d hits, %d misses" % (align_cache.hits, align_cache.misses)
+        align_cache.close()
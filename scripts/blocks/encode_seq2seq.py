@@ -0,0 +1,170 @@
+'''
+Encodes the seq2seq files written by extract_seq2seq.py as integer arrays that a trainer can memory-map, so that
+examples are sliced out of an array instead of being split into tokens again on every epoch. One pass over the files
+builds the source and target vocabularies and encodes every split. For each split and side (source or target) the
+output directory holds a shard of .npy files:
+  <split>.<side>.ids.npy              int32 token ids of every example, concatenated, without the " | " markers
+  <split>.<side>.offsets.npy          example i is ids[offsets[i]:offsets[i+1]]
+  <split>.<side>.segments.npy         the position in ids where every segment starts
+  <split>.<side>.segment_offsets.npy  the segments of example i start at segments[segment_offsets[i]:segment_offsets[i+1]]
+and <side>.vocab has one token per line, the token with id k on line k.
+Run python encode_seq2seq.py -h for details.
+'''
+import argparse
+import os
+import numpy as np
+
+sides = ["source", "target"]
+array_names = ["ids", "offsets", "segments", "segment_offsets"]
+reserved_tokens = ["<pad>", "<unk>"]
+pad_id, unk_id = range(len(reserved_tokens))
+segment_marker = "|"
+
+
+class VocabularyBuilder(object):
+    '''
+    Numbers tokens in the order they are first seen, and counts how often each is seen in the split the vocabulary is
+    built from. finish() turns the first-seen numbering into the final vocabulary.
+    '''
+
+    def __init__(self):
+        self.ids = {}
+        self.tokens = []
+        self.counts = []
+
+    def add(self, token, count):
+        token_id = self.ids.get(token)
+        if token_id is None:
+            token_id = self.ids[token] = len(self.tokens)
+            self.tokens.append(token)
+            self.counts.append(0)
+        if count:
+            self.counts[token_id] += 1
+        return token_id
+
+    def finish(self, min_count=1):
+        # the vocabulary (the reserved tokens, then every token counted at least min_count times, most frequent first)
+        # and an array mapping first-seen numbers to vocabulary ids; all other tokens map to <unk>
+        kept = [i for i in range(len(self.tokens)) if self.counts[i] >= max(min_count, 1)]
+        kept.sort(key=lambda i: (-self.counts[i], self.tokens[i]))
+        vocabulary = reserved_tokens + [self.tokens[i] for i in kept]
+        remap = np.empty(len(self.tokens), dtype=np.int32)
+        remap.fill(unk_id)
+        remap[np.array(kept, dtype=np.int64)] = np.arange(len(reserved_tokens), len(vocabulary), dtype=np.int32)
+        return vocabulary, remap
+
+
+def encode_text(text, builder, count, ids, segments):
+    # appends the tokens of one side of an example to ids, and the start of each of its segments to segments
+    segments.append(len(ids))
+    for token in text.split():
+        if token == segment_marker:
+            segments.append(len(ids))
+        else:
+            ids.append(builder.add(token, count))
+
+
+def encode_file(path, builders, count):
+    # the first-seen numbered arrays of both sides of every example in a seq2seq file
+    arrays = {}
+    for side in sides:
+        arrays[side] = ([], [0], [], [0])
+    with open(path) as fin:
+        for (line_num, line) in enumerate(fin):
+            texts = line.rstrip("\n").split("\t")
+            if len(texts) != len(sides):
+                raise ValueError("{} line {}: expected a source and a target separated by a tab".format(path, line_num + 1))
+            for (side, text) in zip(sides, texts):
+                (ids, offsets, segments, segment_offsets) = arrays[side]
+                encode_text(text, builders[side], count, ids, segments)
+                offsets.append(len(ids))
+                segment_offsets.append(len(segments))
+    for side in sides:
+        (ids, offsets, segments, segment_offsets) = arrays[side]
+        arrays[side] = dict(zip(array_names, [np.array(ids, dtype=np.int32), np.array(offsets, dtype=np.int64),
+                                              np.array(segments, dtype=np.int64), np.array(segment_offsets, dtype=np.int64)]))
+    return arrays
+
+
+def encode(input_files, vocab_split, output_dir, min_count=1):
+    '''
+    Encodes the seq2seq files in input_files, a list of (split, path) pairs, into shards in output_dir. The vocabularies
+    are built from the vocab_split file; tokens seen fewer than min_count times in it are encoded as <unk>. Returns the
+    source and target vocabularies.
+    '''
+    if vocab_split not in [split for (split, path) in input_files]:
+        raise ValueError("No input file for the vocabulary split {}".format(vocab_split))
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    builders = dict((side, VocabularyBuilder()) for side in sides)
+    shards = [(split, encode_file(path, builders, split == vocab_split)) for (split, path) in input_files]
+
+    vocabularies = {}
+    for side in sides:
+        (vocabulary, remap) = builders[side].finish(min_count)
+        vocabularies[side] = vocabulary
+        with open(os.path.join(output_dir, side + ".vocab"), "w") as fout:
+            for token in vocabulary:
+                fout.write(token + "\n")
+        for (split, arrays) in shards:
+            arrays[side]["ids"] = remap[arrays[side]["ids"]]
+            for name in array_names:
+                np.save(os.path.join(output_dir, "{}.{}.{}.npy".format(split, side, name)), arrays[side][name])
+    return vocabularies
+
+
+def load_vocabulary(output_dir, side):
+    with open(os.path.join(output_dir, side + ".vocab")) as fin:
+        return [line.rstrip("\n") for line in fin]
+
+
+def decode(vocabulary, segments):
+    # the seq2seq text of one side of an example, from the ids of its segments
+    return " | ".join(" ".join(vocabulary[token_id] for token_id in segment) for segment in segments)
+
+
+class Seq2SeqShard(object):
+    '''
+    The encoded examples of one split, memory-mapped. ids() and segments() return slices of the mapped arrays, so
+    nothing is copied until the slices are read.
+    '''
+
+    def __init__(self, output_dir, split):
+        self.arrays = {}
+        for side in sides:
+            for name in array_names:
+                path = os.path.join(output_dir, "{}.{}.{}.npy".format(split, side, name))
+                self.arrays[side, name] = np.load(path, mmap_mode="r")
+
+    def __len__(self):
+        return len(self.arrays["source", "offsets"]) - 1
+
+    def ids(self, i, side="source"):
+        offsets = self.arrays[side, "offsets"]
+        return self.arrays[side, "ids"][offsets[i]:offsets[i+1]]
+
+    def segments(self, i, side="source"):
+        # the ids of every segment of example i, in order
+        ids = self.arrays[side, "ids"]
+        segment_offsets = self.arrays[side, "segment_offsets"]
+        starts = self.arrays[side, "segments"][segment_offsets[i]:segment_offsets[i+1]].tolist()
+        ends = starts[1:] + [int(self.arrays[side, "offsets"][i+1])]
+        return [ids[start:end] for (start, end) in zip(starts, ends)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-input_prefix", type=str, required=True, help="Prefix of the seq2seq files to encode (the -output_prefix of extract_seq2seq.py)")
+    parser.add_argument("-splits", type=str, nargs="+", default=["train", "val", "test"], help="Splits to encode; the file of each is <input_prefix>.<split>")
+    parser.add_argument("-vocab_split", type=str, default="train", help="Split to build the vocabularies from")
+    parser.add_argument("-min_count", type=int, default=1, help="Encode tokens seen fewer times than this in the vocabulary split as <unk>")
+    parser.add_argument("-output_dir", type=str, required=True, help="Directory to write the vocabularies and shards to")
+    args = parser.parse_args()
+
+    input_files = [(split, "{}.{}".format(args.input_prefix, split)) for split in args.splits]
+    vocabularies = encode(input_files, args.vocab_split, args.output_dir, args.min_count)
+    print "Vocabulary sizes: %s" % ", ".join("%s %d" % (side, len(vocabularies[side])) for side in sides)
+    for split in args.splits:
+        shard = Seq2SeqShard(args.output_dir, split)
+        print "%s: %d examples, %s" % (split, len(shard), ", ".join("%d %s tokens" % (len(shard.arrays[side, "ids"]), side) for side in sides))
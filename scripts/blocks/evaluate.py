@@ -8,13 +8,15 @@ import os
 import argparse
 import re
 import csv
+import math
+from multiprocessing import Pool
 from bitmap import *
 import matplotlib.pyplot as plt
 
 distance_field = "hamming_distance"
 bmp_file_pattern = r'(img_[0-9]+)\.txt'
 gif_pattern = r'(img_[0-9]+)\.gif'
-global search_area
+search_area = 5
 max_blocks_for_drawn_image = 10
 max_hamming = 20
 
@@ -31,34 +33,120 @@ def load_true_images(dirname):
     return true_images
 
 
-def evaluate(truth, pred):
-    (xdiff, ydiff) = find_corner(truth)
-    hamming_distances = []
-    search_space = [(xdiff, ydiff)]
-    search_space.extend([(x_offset, ydiff) for x_offset in range(xdiff - 5, xdiff + 5) if x_offset != xdiff])
-    search_space.extend([(xdiff, y_offset) for y_offset in range(ydiff - 5, ydiff + 5) if y_offset != ydiff])
-    search_space.extend([(x_offset, y_offset) for x_offset in range(xdiff - 5, xdiff + 5) for y_offset in range(ydiff - 5, ydiff + 5) if x_offset != xdiff and y_offset != ydiff])
-
-    for (x_offset, y_offset) in search_space:
-        aligned_pred, removed_blocks = align(pred, (x_offset, y_offset))
-        distance = hamming_distance(truth, aligned_pred)
-        distance += removed_blocks
-        hamming_distances.append(distance)
-        # if there's an exact match, stop
-        if distance == 0:
-            break
-
-    return min(hamming_distances)
+def evaluate(truth, pred, search_area=None):
+    distance, shift = find_best_shift(truth, pred, search_area)
+    return distance
+
+
+def find_best_shift(truth, pred, search_area=None):
+    '''
+    Superimposes the top-left corner of pred on that of truth, then tries every translation of pred that moves its
+    corner by [-search_area, search_area) rows and columns. Returns the minimum Hamming distance (blocks moved off the
+    grid count as mismatches) and the (row, col) shift applied to pred that produced it. truth and pred are either
+    dense bitmaps or SparseBitmaps; the search only looks at the blocks, so both give the same result on the same board.
+    '''
+    if search_area is None:
+        search_area = globals()["search_area"]
+    if isinstance(truth, SparseBitmap):
+        (truth_blocks, pred_blocks) = (truth.cells, pred.cells)
+        (truth_corner, pred_corner) = (truth.corner(), pred.corner())
+    else:
+        (truth_blocks, pred_blocks) = (np.argwhere(truth == 1), np.argwhere(pred == 1))
+        (truth_corner, pred_corner) = (find_corner(truth), find_corner(pred))
+    first_shift = (truth_corner[0] - pred_corner[0] - search_area, truth_corner[1] - pred_corner[1] - search_area)
+    distances = shift_distances(truth_blocks, pred_blocks, first_shift, max(2 * search_area, 1))
+
+    # prefer the plain corner alignment on ties, then the first shift in row-major order
+    best = (search_area, search_area)
+    if distances[best] != distances.min():
+        best = np.unravel_index(np.argmin(distances), distances.shape)
+    shift = (first_shift[0] + int(best[0]), first_shift[1] + int(best[1]))
+    return int(distances[best]), shift
+
+
+def evaluate_batch(truths, preds, workers=1, search_area=None):
+    '''
+    Scores stacked (N, rows, cols) arrays of true and predicted bitmaps pairwise, or two lists of SparseBitmaps. The pairs
+    are split into chunks that are scored in a pool of worker processes. Returns an array of N distances and an (N, 2)
+    array of the shifts that produced them, both in input order.
+    '''
+    if search_area is None:
+        search_area = globals()["search_area"]
+    if isinstance(truths, list) and truths and isinstance(truths[0], SparseBitmap):
+        preds = list(preds)
+    else:
+        truths = np.asarray(truths)
+        preds = np.asarray(preds)
+    assert len(truths) == len(preds), "got {} true bitmaps but {} predictions".format(len(truths), len(preds))
+
+    num_pairs = len(truths)
+    if workers <= 1 or num_pairs < 2:
+        results = [evaluate_chunk((truths, preds, search_area))]
+    else:
+        # a few chunks per worker keeps the pool busy when some chunks are slower than others
+        chunk_size = int(math.ceil(num_pairs / float(workers * 4)))
+        chunks = [(truths[i:i + chunk_size], preds[i:i + chunk_size], search_area) for i in range(0, num_pairs, chunk_size)]
+        pool = Pool(workers)
+        try:
+            results = pool.map(evaluate_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+
+    distances = np.concatenate([np.asarray(r[0], dtype=int) for r in results])
+    shifts = np.concatenate([np.asarray(r[1], dtype=int).reshape(-1, 2) for r in results])
+    return distances, shifts
+
+
+def evaluate_sequences(true_sequences, pred_sequences, dims, workers=1, search_area=None):
+    '''
+    Scores pairs of absolute event sequences with evaluate_batch on rows x cols bitmaps made by render_batch. render_batch
+    drops blocks outside the grid, so pairs with any such block are scored on SparseBitmaps instead, where every block
+    counts. Returns the distances and shifts, in input order, and the number of pairs scored on sparse boards.
+    '''
+    true_bitmaps, true_off_grid = render_batch(true_sequences, dims)
+    pred_bitmaps, pred_off_grid = render_batch(pred_sequences, dims)
+    off_grid = true_off_grid | pred_off_grid
+
+    distances = np.zeros(len(true_sequences), dtype=int)
+    shifts = np.zeros((len(true_sequences), 2), dtype=int)
+    if not off_grid.all():
+        (distances[~off_grid], shifts[~off_grid]) = evaluate_batch(true_bitmaps[~off_grid], pred_bitmaps[~off_grid], workers, search_area)
+    if off_grid.any():
+        indices = np.flatnonzero(off_grid)
+        (distances[off_grid], shifts[off_grid]) = evaluate_batch([SparseBitmap.from_events(true_sequences[i]) for i in indices],
+                                                                 [SparseBitmap.from_events(pred_sequences[i]) for i in indices],
+                                                                 workers, search_area)
+    return distances, shifts, int(np.count_nonzero(off_grid))
+
+
+def evaluate_chunk(chunk):
+    (truths, preds, search_area) = chunk
+    distances = []
+    shifts = []
+    for truth, pred in zip(truths, preds):
+        distance, shift = find_best_shift(truth, pred, search_area)
+        distances.append(distance)
+        shifts.append(shift)
+    return distances, shifts
+
+
+def shift_distances(truth_blocks, pred_blocks, first_shift, window):
+    '''
+    Given the (row, col) coordinates of the blocks in two images, returns a window x window array whose entry [i, j] is
+    the Hamming distance between truth and pred moved by (first_shift[0] + i, first_shift[1] + j). Any pred block that
+    does not land on a truth block is a mismatch whether it stays on the grid or not, so the distance is
+    |truth| + |pred| - 2 * overlap, and the overlap for all shifts comes from one cross-correlation of the block sets.
+    '''
+    overlap = np.zeros(window * window, dtype=int)
+    if len(truth_blocks) > 0 and len(pred_blocks) > 0:
+        offsets = (truth_blocks[:, None, :] - pred_blocks[None, :, :]).reshape(-1, 2) - np.asarray(first_shift)
+        inside = np.all((offsets >= 0) & (offsets < window), axis=1)
+        overlap += np.bincount(offsets[inside, 0] * window + offsets[inside, 1], minlength=window * window)
+    return len(truth_blocks) + len(pred_blocks) - 2 * overlap.reshape(window, window)
 
 def hamming_distance(truth, pred):
-    dist = 0
-    (rows, cols) = truth.shape
-    for i in range(0, rows):
-        for j in range(0, cols):
-            if truth[i, j] != pred[i,j]:
-                dist += 1
-
-    return dist
+    return int(np.count_nonzero(truth != pred))
 
 
 def align(pred, corner):
@@ -68,49 +156,42 @@ def align(pred, corner):
     return aligned, removed_blocks
 
 
+def shifted_slices(size, diff):
+    # source and destination slices along one axis for moving every cell at index i to i - diff
+    if diff >= 0:
+        return slice(min(diff, size), size), slice(0, max(size - diff, 0))
+    return slice(0, max(size + diff, 0)), slice(min(-diff, size), size)
+
+
 def translate(bmp, xdiff=0, ydiff=0):
     if xdiff == 0 and ydiff == 0:
         return bmp, 0
-    removed_blocks = 0
+    blocks = (bmp == 1)
     aligned_bmp = np.zeros(bmp.shape, dtype=int)
     (rows, cols) = bmp.shape
-    for i in range(0, rows):
-        for j in range(0, cols):
-            if bmp[i,j] == 1:
-                if (i - xdiff) in range(0, rows) and (j - ydiff) in range(0, cols):
-                    aligned_bmp[i - xdiff, j - ydiff] = 1
-                else:
-                    # if a block moves off the grid during translation, add 1 to the hamming distance
-                    removed_blocks += 1
+    (src_rows, dst_rows) = shifted_slices(rows, xdiff)
+    (src_cols, dst_cols) = shifted_slices(cols, ydiff)
+    kept = blocks[src_rows, src_cols]
+    aligned_bmp[dst_rows, dst_cols] = kept
+    # if a block moves off the grid during translation, add 1 to the hamming distance
+    removed_blocks = int(np.count_nonzero(blocks)) - int(np.count_nonzero(kept))
 
     return aligned_bmp, removed_blocks
 
 
 def find_corner(bmp):
-    x = -1
-    y = -1
-    rows, cols = bmp.shape
-    for i in range(0, rows):
-        if 1 in bmp[i, :]:
-            x = i
-            break
-    for i in range(0, cols):
-        if 1 in bmp[:,i]:
-            y = i
-            break
+    blocks = (bmp == 1)
+    rows_with_blocks = blocks.any(axis=1)
+    cols_with_blocks = blocks.any(axis=0)
+    x = int(np.argmax(rows_with_blocks)) if rows_with_blocks.any() else -1
+    y = int(np.argmax(cols_with_blocks)) if cols_with_blocks.any() else -1
 
     return (x,y)
 
 def count_blocks(bmp):
-    ctr = 0
-    (rows, cols) = bmp.shape
-    for i in range(0, rows):
-        for j in range(0, cols):
-            if bmp[i, j] == 1:
-                ctr +=1
-    return ctr
+    return int(np.count_nonzero(bmp == 1))
 
-def get_hamming_distances(inp, true_image_dir, output_file, generator, image_url_field, actions_field):
+def get_hamming_distances(inp, true_image_dir, output_file, generator, image_url_field, actions_field, workers=1):
     true_images = load_true_images(true_image_dir)
     reader = csv.reader(open(inp, 'Ur'))
     writer = csv.writer(open(output_file, 'w'))
@@ -128,6 +209,9 @@ def get_hamming_distances(inp, true_image_dir, output_file, generator, image_url
     too_many_blocks = 0
     too_few_blocks = 0
     exact_matches = 0
+    candidate_rows = []
+    true_bitmaps = []
+    drawn_bitmaps = []
     for row in reader:
         ctr += 1
         if ctr % 500 == 0:
@@ -149,8 +233,16 @@ def get_hamming_distances(inp, true_image_dir, output_file, generator, image_url
             print "Skipping row: Too few blocks in drawn image", row
             too_few_blocks += 1
             continue
-        true_image = true_images[image_key]
-        distance = evaluate(true_image, drawn_image)
+        candidate_rows.append(row)
+        true_bitmaps.append(true_images[image_key])
+        drawn_bitmaps.append(drawn_image.copy())
+
+    distances = []
+    if candidate_rows:
+        distances, shifts = evaluate_batch(true_bitmaps, drawn_bitmaps, workers=workers)
+
+    for row, distance in zip(candidate_rows, distances):
+        distance = int(distance)
         if distance > max_hamming:
             print "Skipping row: Hamming distance too large (> %d)" % max_hamming, row
             continue
@@ -186,11 +278,12 @@ if __name__ == "__main__":
     parser.add_argument("-image_field", type=str, default="Input.Image_url", help="Name of CSV field containing image URL")
     parser.add_argument("-draw_events_field", type=str, default="Answer.WritingTexts", help="Name of CSV field containing drawing task events")
     parser.add_argument("-search_area", type=int, default=5, help="Maximum x and y directions to move drawn image in after superimposing to find minimum hamming distance")
+    parser.add_argument("-workers", type=int, default=1, help="Number of processes to compute Hamming distances with")
 
     args = parser.parse_args()
     generator = BitmapMaker(args.bitmap_dim, args.bitmap_dim)
     image_url_field = args.image_field
     actions_field = args.draw_events_field
     search_area = args.search_area
-    distances = get_hamming_distances(args.csv, args.image_dir, args.output_file, generator, image_url_field, actions_field)
+    distances = get_hamming_distances(args.csv, args.image_dir, args.output_file, generator, image_url_field, actions_field, args.workers)
     get_distance_stats(distances)
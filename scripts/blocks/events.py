@@ -1,38 +1,235 @@
 __author__ = 'mkayser'
 '''
 Provides basic classes to represent absolute or relative event sequences.
+
+Every sequence stores its events as an int8 array of opcodes plus an (n, 2) int32 array of coordinates (zero for
+events that take no arguments). The list-of-lists view, e.g. [["START"], ["PUT", 0, 1]], is still available through
+the events attribute.
 '''
+import numpy as np
+
+
+# Opcodes shared by all sequence types
+op_names = ["ADD", "DEL", "START", "PUT", "UP", "DOWN", "LEFT", "RIGHT", "BLOCK"]
+op_codes = dict((name, code) for (code, name) in enumerate(op_names))
+ADD, DEL, START, PUT, UP, DOWN, LEFT, RIGHT, BLOCK = range(len(op_names))
+
+op_dtype = np.int8
+coord_dtype = np.int32
+run_dtype = np.int32
 
+# Whether each opcode takes two coordinate arguments
+op_has_coords = [name in ["ADD", "DEL", "PUT"] for name in op_names]
+
+# (row, col) step taken by each cursor opcode
+cursor_moves = np.zeros((len(op_names), 2), dtype=np.int_)
+cursor_moves[UP] = (-1, 0)
+cursor_moves[DOWN] = (1, 0)
+cursor_moves[LEFT] = (0, -1)
+cursor_moves[RIGHT] = (0, 1)
+
+cursor_tokens = set(["UP", "DOWN", "LEFT", "RIGHT", "BLOCK"])
 
 
 def is_int(s):
-    try: 
+    try:
         int(s)
         return True
     except ValueError:
         return False
 
 
-class AbsoluteEventSequence(object):
-    events = []
-    # Coordinates in ROW, COL format, like for matrices
+def to_arrays(ops, coords):
+    ops = np.asarray(ops, dtype=op_dtype).reshape(-1)
+    coords = np.asarray(coords)
+    if coords.dtype != coord_dtype and coords.size:
+        # casting would silently wrap coordinates that do not fit
+        limits = np.iinfo(coord_dtype)
+        out_of_range = (coords < limits.min) | (coords > limits.max)
+        if out_of_range.any():
+            raise ValueError("Coordinates must be between {} and {}; got {}".format(limits.min, limits.max, coords[out_of_range][0]))
+    coords = coords.astype(coord_dtype).reshape(-1, 2)
+    assert len(ops) == len(coords), "got {} opcodes but {} coordinate pairs".format(len(ops), len(coords))
+    return ops, coords
+
+
+def merge_runs(ops, counts):
+    # drop empty runs and merge neighbouring runs of the same opcode
+    ops = np.asarray(ops, dtype=op_dtype).reshape(-1)
+    counts = np.asarray(counts, dtype=run_dtype).reshape(-1)
+    nonempty = counts > 0
+    (ops, counts) = (ops[nonempty], counts[nonempty])
+    if len(ops) == 0:
+        return ops, counts
+    starts = np.concatenate([[0], np.flatnonzero(ops[1:] != ops[:-1]) + 1])
+    return ops[starts], np.add.reduceat(counts, starts).astype(run_dtype)
+
+
+def events_to_arrays(events):
+    ops = []
+    coords = []
+    for e in events:
+        if e[0] not in op_codes:
+            raise Exception("Unknown event: {}".format(e))
+        code = op_codes[e[0]]
+        ops.append(code)
+        coords.append((int(e[1]), int(e[2])) if op_has_coords[code] else (0, 0))
+    return to_arrays(ops, coords)
+
+
+def parse_eval_strings(eval_strs, sequence_type="relative"):
+    '''
+    Parses many decoder outputs (or any strings from_eval_str accepts) in one pass. Returns packed opcode and coordinate
+    arrays for all sequences plus an offsets array: sequence i is ops[offsets[i]:offsets[i+1]]. Malformed tokens are
+    handled exactly as RelativeEventSequence.from_tokens and CursorEventSequence.from_tokens handle them.
+    '''
+    if sequence_type not in ["relative", "cursor"]:
+        raise Exception("Unknown or unsupported sequence type: {}".format(sequence_type))
+    ops = []
+    coords = []
+    offsets = [0]
+    # decoder vocabularies are small, so remember whether each distinct token is an int instead of re-parsing it
+    token_ints = {}
+
+    def as_int(token):
+        if token not in token_ints:
+            token_ints[token] = int(token) if is_int(token) else None
+        return token_ints[token]
+
+    for eval_str in eval_strs:
+        tokens = eval_str.replace("</s>","").replace("<s>","").split()
+        n = len(tokens)
+        i = 0
+        if sequence_type == "relative":
+            while i < n:
+                token = tokens[i]
+                if token == "START":
+                    if i == 0:
+                        ops.append(START)
+                        coords.append((0, 0))
+                    i += 1
+                elif token == "PUT" and i > 0 and i+2 < n:
+                    (row, col) = (as_int(tokens[i+1]), as_int(tokens[i+2]))
+                    if row is not None and col is not None:
+                        ops.append(PUT)
+                        coords.append((row, col))
+                        i += 3
+                    else:
+                        i += 1
+                else:
+                    i += 1
+        else:
+            ops.append(START)
+            coords.append((0, 0))
+            for token in tokens:
+                if token == "START":
+                    continue
+                if token not in cursor_tokens:
+                    raise Exception("Unexpected cursor token: {}".format(token))
+                ops.append(op_codes[token])
+                coords.append((0, 0))
+        offsets.append(len(ops))
+
+    (ops, coords) = to_arrays(ops, coords)
+    return ops, coords, np.array(offsets, dtype=np.int_)
+
+
+def parse_eval_file(file_name, sequence_type="relative", field=None):
+    '''
+    Like parse_eval_strings, for a file with one sequence per line. If field is given, lines are split on tabs and only
+    that field is parsed, e.g. field=1 for the action side of the aligned seq2seq files. Segment separators (" | ") are
+    dropped, as in AbsoluteEventSequence.from_aligned_string.
+    '''
+    with open(file_name) as fin:
+        lines = (l.rstrip("\n") for l in fin)
+        if field is not None:
+            lines = (l.split("\t")[field] for l in lines)
+        return parse_eval_strings([l.replace(" | ", " ") for l in lines], sequence_type)
+
+
+class StreamingCanonicalizer(object):
+    '''
+    Drops block adds that are later deleted, one event at a time. For each cell it remembers where the adds since the
+    last DEL of that cell went, so a DEL only touches its own cell and every event is handled in O(1).
+    '''
+    def __init__(self):
+        self.ops = []
+        self.coords = []
+        self.live_adds = {}
+
+    def add(self, op, row, col):
+        cell = (row, col)
+        if op == DEL:
+            for i in self.live_adds.pop(cell, []):
+                self.ops[i] = None
+        else:
+            self.live_adds.setdefault(cell, []).append(len(self.ops))
+            self.ops.append(op)
+            self.coords.append(cell)
+
+    def arrays(self):
+        kept = [i for (i, op) in enumerate(self.ops) if op is not None]
+        return to_arrays([self.ops[i] for i in kept], [self.coords[i] for i in kept])
+
+
+class EventSequence(object):
+    __slots__ = ("ops", "coords")
 
     def __init__(self, events):
-        self.events = events
+        (self.ops, self.coords) = events_to_arrays(events)
+
+    @classmethod
+    def from_arrays(cls, ops, coords):
+        seq = cls.__new__(cls)
+        (seq.ops, seq.coords) = to_arrays(ops, coords)
+        return seq
+
+    @classmethod
+    def split_packed(cls, ops, coords, offsets):
+        # views into the packed arrays, so no events are copied
+        return [cls.from_arrays(ops[start:end], coords[start:end]) for (start, end) in zip(offsets[:-1], offsets[1:])]
+
+    @property
+    def events(self):
+        events = []
+        for code, (row, col) in zip(self.ops.tolist(), self.coords.tolist()):
+            if op_has_coords[code]:
+                events.append([op_names[code], row, col])
+            else:
+                events.append([op_names[code]])
+        return events
+
+    def tokens(self):
+        tokens = []
+        for code, (row, col) in zip(self.ops.tolist(), self.coords.tolist()):
+            tokens.append(op_names[code])
+            if op_has_coords[code]:
+                tokens.append(str(row))
+                tokens.append(str(col))
+        return tokens
+
+    def __len__(self):
+        return len(self.ops)
 
     def __str__(self):
-        return " ".join([" ".join(map(str,l)) for l in self.events])
+        return " ".join(self.tokens())
+
+
+class AbsoluteEventSequence(EventSequence):
+    # Coordinates in ROW, COL format, like for matrices
+    __slots__ = ()
 
     # Strip out any block adds which are later deleted
     def canonicalize(self):
-        keep = [True for e in self.events]
-        for i,e in enumerate(self.events):
-            if e[0] == "DEL":
-                for j in range(i+1):
-                    if self.events[j][1:] == e[1:]:
-                        keep[j]=False
-        canonical_events = [list(e) for e,k in zip(self.events,keep) if k]
-        return AbsoluteEventSequence(canonical_events)
+        if len(self.ops) == 0:
+            return AbsoluteEventSequence([])
+        # an event is kept unless a DEL of the same cell comes at or after it
+        (cells, cell_ids) = np.unique(self.coords, axis=0, return_inverse=True)
+        last_del = np.full(len(cells), -1, dtype=np.int_)
+        dels = np.flatnonzero(self.ops == DEL)
+        np.maximum.at(last_del, cell_ids[dels], dels)
+        keep = np.arange(len(self.ops)) > last_del[cell_ids]
+        return AbsoluteEventSequence.from_arrays(self.ops[keep], self.coords[keep])
 
     @classmethod
     def from_string(cls, events_str):
@@ -42,11 +239,19 @@ class AbsoluteEventSequence(object):
         for i in range(0,len(tokens),3):
             action,arg1,arg2 = (tokens[i],tokens[i+1],tokens[i+2])
             events.append([action, int(arg1), int(arg2)])
-        return cls(events)    
+        return cls(events)
 
     @classmethod
-    def from_mturk_string(cls, events_str):
+    def from_mturk_string(cls, events_str, canonicalize=False):
         lines = events_str.strip().replace("\r","").split("\n")
+        if canonicalize:
+            canonicalizer = StreamingCanonicalizer()
+            for l in lines:
+                action,arg1,arg2 = l.strip().split()
+                if action not in op_codes:
+                    raise Exception("Unknown event: {}".format([action, arg1, arg2]))
+                canonicalizer.add(op_codes[action], int(arg1), int(arg2))
+            return cls.from_arrays(*canonicalizer.arrays())
         events = []
         for l in lines:
             action,arg1,arg2 = l.strip().split()
@@ -55,54 +260,56 @@ class AbsoluteEventSequence(object):
 
     @classmethod
     def from_relative(cls,rel,gridx,gridy):
-        abs_events = []
-        prevpos = None
-
-        for i,e in enumerate(rel.events):
-            if e == ["START"]:
-                assert(prevpos is None)
-                pos = [int(gridx/2),int(gridy/2)]
-            elif e[0] == "PUT":
-                #assert(prevpos is not None)
-                if prevpos is None:
-                    pos = [int(gridx/2),int(gridy/2)]
-                else:
-                    pos = [prevpos[0]+e[1], prevpos[1]+e[2]]
-            else:
-                raise Exception("Unsupported relative event: {}".format(e))
-            abs_events.append(["ADD", pos[0], pos[1]])
-            prevpos = pos
-        return cls(abs_events)
+        ops = rel.ops
+        if len(ops) == 0:
+            return cls([])
+
+        if ops[0] not in (START, PUT) or (ops[1:] != PUT).any():
+            for i,e in enumerate(rel.events):
+                assert not (e == ["START"] and i > 0)
+                if e[0] not in ["START", "PUT"]:
+                    raise Exception("Unsupported relative event: {}".format(e))
+
+        # the first event (START, or a PUT without a previous block) lands in the center; every PUT after that jumps
+        jumps = rel.coords.astype(np.int_)
+        jumps[0] = (int(gridx/2), int(gridy/2))
+        positions = np.cumsum(jumps, axis=0)
+        return cls.from_arrays(np.full(len(ops), ADD, dtype=op_dtype), positions)
 
     @classmethod
-    def from_cursor(cls,cur,gridx,gridy):
-        abs_events = []
-        pos=None
-
-        def check_pos(pos):
-            if pos[0] < 0 or pos[0] >= gridy or pos[1] < 0 or pos[1] >= gridx:
-                raise Exception("Converting from cursor to absolute with grid size=({},{}) yields off-grid position: {}".format(gridy,gridx,pos))
-
-        for i,e in enumerate(cur.events):
-            if e == ["START"]:
-                assert(pos is None)
-                pos = [int(gridx/2),int(gridy/2)]
-                abs_events.append(["ADD", pos[0], pos[1]])
-            elif e == ["UP"]:
-                pos[0]-=1
-            elif e == ["DOWN"]:
-                pos[0]+=1
-            elif e == ["LEFT"]:
-                pos[1]-=1
-            elif e == ["RIGHT"]:
-                pos[1]+=1
-            elif e == ["BLOCK"]:
-                abs_events.append(["ADD", pos[0], pos[1]])
-            else:
-                raise Exception("Unknown cursor command: {}".format(e))
-            check_pos(pos)
-
-        return cls(abs_events)
+    def from_cursor(cls,cur,gridx,gridy,bounded=True):
+        # with bounded=False the cursor may leave the grid, e.g. when the result is drawn on a SparseBitmap
+        (ops, counts) = (cur.ops, cur.counts.astype(np.int_))
+        if len(ops) == 0:
+            return cls([])
+
+        if ops[0] != START or counts[0] != 1 or (ops[1:] < UP).any():
+            for i,e in enumerate(cur.events):
+                assert (e == ["START"]) == (i == 0)
+                if e[0] not in ["START", "UP", "DOWN", "LEFT", "RIGHT", "BLOCK"]:
+                    raise Exception("Unknown cursor command: {}".format(e))
+
+        # cursor position at the end of each run
+        steps = cursor_moves[ops] * counts[:, None]
+        steps[0] = (int(gridx/2), int(gridy/2))
+        positions = np.cumsum(steps, axis=0)
+
+        def off_grid(pos):
+            return (pos[:, 0] < 0) | (pos[:, 0] >= gridy) | (pos[:, 1] < 0) | (pos[:, 1] >= gridx)
+
+        (low, high) = (positions.min(axis=0), positions.max(axis=0))
+        if bounded and (low[0] < 0 or high[0] >= gridy or low[1] < 0 or high[1] >= gridx):
+            # runs are straight lines, so only the first run that ends off the grid needs to be walked step by step
+            k = np.flatnonzero(off_grid(positions))[0]
+            walk = positions[k:k+1]
+            if k > 0:
+                walk = positions[k-1] + cursor_moves[ops[k]] * np.arange(1, counts[k] + 1)[:, None]
+            pos = walk[np.flatnonzero(off_grid(walk))[0]].tolist()
+            raise Exception("Converting from cursor to absolute with grid size=({},{}) yields off-grid position: {}".format(gridy,gridx,pos))
+
+        placed = (ops == START) | (ops == BLOCK)
+        positions = np.repeat(positions[placed], counts[placed], axis=0)
+        return cls.from_arrays(np.full(len(positions), ADD, dtype=op_dtype), positions)
 
     @classmethod
     def from_aligned_string(cls, events_str):
@@ -110,41 +317,30 @@ class AbsoluteEventSequence(object):
         return cls.from_string(events_str)
 
 
-class RelativeEventSequence(object):
-    events = []
+class RelativeEventSequence(EventSequence):
     # Coordinates in ROWJUMP, COLJUMP format
-
-    def __init__(self, events):
-        self.events = events
-
-    def __str__(self):
-        return " ".join([" ".join(map(str,l)) for l in self.events])
+    __slots__ = ()
 
     @classmethod
     def from_absolute(cls, absolute):
-        events = absolute.events
-        rel_events = []
-        prevpos = [None,None]
-
-        for i,e in enumerate(events):
-            pos = e[1:]
-            if i==0: 
-                rel_events.append(["START"])
-            else:
-                jump = [a-b for a,b in zip(pos,prevpos)]
-                rel_events.append(["PUT"] + jump)
-            prevpos = pos
-
-        return cls(rel_events)
+        n = len(absolute.ops)
+        ops = np.full(n, PUT, dtype=op_dtype)
+        coords = np.zeros((n, 2), dtype=np.int_)
+        if n > 0:
+            ops[0] = START
+            coords[1:] = np.diff(absolute.coords.astype(np.int_), axis=0)
+        return cls.from_arrays(ops, coords)
 
     @classmethod
     def from_tokens(cls, tokens):
         i=0
-        events = []
+        ops = []
+        coords = []
         while i<len(tokens):
             if tokens[i] == "START":
                 if i==0:
-                    events.append(["START"])
+                    ops.append(START)
+                    coords.append((0, 0))
                 else:
                     pass
                 i += 1
@@ -153,13 +349,14 @@ class RelativeEventSequence(object):
                     i += 1
                 else:
                     if i+2 < len(tokens) and is_int(tokens[i+1]) and is_int(tokens[i+2]):
-                        events.append(["PUT",int(tokens[i+1]),int(tokens[i+2])])
+                        ops.append(PUT)
+                        coords.append((int(tokens[i+1]), int(tokens[i+2])))
                         i += 3
                     else:
                         i += 1
             else:
                 i += 1
-        return cls(events)
+        return cls.from_arrays(ops, coords)
 
     @classmethod
     def from_eval_str(cls, eval_str):
@@ -169,56 +366,82 @@ class RelativeEventSequence(object):
 
 
 
-class CursorEventSequence(object):
-    events = []
-    # UP/DOWN/LEFT/RIGHT sequence
+class CursorEventSequence(EventSequence):
+    # UP/DOWN/LEFT/RIGHT sequence, stored run-length encoded: opcode ops[k] repeated counts[k] times
+    __slots__ = ("counts",)
 
     def __init__(self, events):
-        self.events = events
+        (ops, coords) = events_to_arrays(events)
+        self.set_runs(ops, np.ones(len(ops), dtype=run_dtype))
 
-    def __str__(self):
-        return " ".join([" ".join(map(str,l)) for l in self.events])
+    def set_runs(self, ops, counts):
+        (self.ops, self.counts) = merge_runs(ops, counts)
+        self.coords = np.zeros((len(self.ops), 2), dtype=coord_dtype)
+
+    @classmethod
+    def from_runs(cls, ops, counts):
+        seq = cls.__new__(cls)
+        seq.set_runs(ops, counts)
+        return seq
+
+    @classmethod
+    def from_arrays(cls, ops, coords):
+        ops = np.asarray(ops, dtype=op_dtype).reshape(-1)
+        return cls.from_runs(ops, np.ones(len(ops), dtype=run_dtype))
+
+    def runs(self):
+        return [(op_names[code], count) for (code, count) in zip(self.ops.tolist(), self.counts.tolist())]
+
+    def token_ops(self):
+        return np.repeat(self.ops, self.counts)
+
+    @property
+    def events(self):
+        return [[op_names[code]] for code in self.token_ops().tolist()]
+
+    def tokens(self):
+        return [op_names[code] for code in self.token_ops().tolist()]
+
+    def __len__(self):
+        return int(self.counts.sum())
 
     @classmethod
     def from_absolute(cls, absolute):
-        events = absolute.events
-        rel_events = []
-        prevpos = [None,None]
-
-        for i,e in enumerate(events):
-            pos = e[1:]
-            if i==0: 
-                rel_events.append(["START"])
-            else:
-                jump = [a-b for a,b in zip(pos,prevpos)]
-                if jump[0] > 0:
-                    rel_events.extend([["DOWN"] for i in range(jump[0])])
-                if jump[0] < 0:
-                    rel_events.extend([["UP"] for i in range(-jump[0])])
-                if jump[1] > 0:
-                    rel_events.extend([["RIGHT"] for i in range(jump[1])])
-                if jump[1] < 0:
-                    rel_events.extend([["LEFT"] for i in range(-jump[1])])
-                rel_events.append(["BLOCK"])
-            prevpos = pos
-
-        return cls(rel_events)
+        n = len(absolute.ops)
+        if n == 0:
+            return cls([])
+
+        # each jump becomes a run of vertical moves, a run of horizontal moves and a BLOCK
+        jumps = np.diff(absolute.coords.astype(np.int_), axis=0)
+        runs = np.empty((n - 1, 3), dtype=op_dtype)
+        runs[:, 0] = np.where(jumps[:, 0] > 0, DOWN, UP)
+        runs[:, 1] = np.where(jumps[:, 1] > 0, RIGHT, LEFT)
+        runs[:, 2] = BLOCK
+        counts = np.ones((n - 1, 3), dtype=run_dtype)
+        counts[:, :2] = np.abs(jumps)
+
+        return cls.from_runs(np.concatenate([[START], runs.ravel()]), np.concatenate([[1], counts.ravel()]))
 
     @classmethod
     def from_tokens(cls, tokens):
         i=0
-        events = []
-        events.append(["START"])
+        ops = [START]
+        counts = [1]
 
         while i<len(tokens):
             if tokens[i] == "START":
                 i += 1
-            elif tokens[i] in ["UP","DOWN","LEFT","RIGHT","BLOCK"]:
-                events.append([tokens[i]])
+            elif tokens[i] in cursor_tokens:
+                code = op_codes[tokens[i]]
+                if code == ops[-1]:
+                    counts[-1] += 1
+                else:
+                    ops.append(code)
+                    counts.append(1)
                 i += 1
             else:
                 raise Exception("Unexpected cursor token: {}".format(tokens[i]))
-        return cls(events)
+        return cls.from_runs(ops, counts)
 
     @classmethod
     def from_eval_str(cls, eval_str):
@@ -1,34 +1,54 @@
-import json
-import sys
 import argparse
 import os
+from collections import defaultdict
+from utils import iter_json_objects
+
+
+def output_file_name(output_prefix, alignments_field, split, num_fields):
+    # <prefix>.<split> for a single alignments field, and <prefix>.<field without "alignments.">.<split> for several
+    if num_fields == 1:
+        return "{}.{}".format(output_prefix, split)
+    suffix = alignments_field[len("alignments."):] if alignments_field.startswith("alignments.") else alignments_field
+    return "{}.{}.{}".format(output_prefix, suffix, split)
+
+
+def extract(json_file, alignments_fields, output_prefix, buffer_size=1 << 20):
+    '''
+    Writes the (commands, actions) pairs of every alignments field to one file per field and data split, reading the
+    dataset one object at a time. Returns the number of pairs written to each file.
+    '''
+    files = {}
+    counts = defaultdict(int)
+    try:
+        for o in iter_json_objects(json_file):
+            split = o["data_split"]
+            for field in alignments_fields:
+                file_name = output_file_name(output_prefix, field, split, len(alignments_fields))
+                if file_name not in files:
+                    files[file_name] = open(file_name, "w", buffer_size)
+                pairs = o[field]
+                left = " | ".join(p[0] for p in pairs)
+                right = " | ".join(p[1] for p in pairs)
+                files[file_name].write("{}\t{}\n".format(left,right))
+                counts[file_name] += 1
+    finally:
+        for fout in files.values():
+            fout.close()
+    return counts
+
 
 if __name__=="__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("-json", type=str, required=True, help="Input json file")
-    parser.add_argument("-alignments_field", type=str, default="alignments.relative", help="Alignments field in json objects")
+    parser.add_argument("-json", type=str, required=True, help="Input json file (a JSON array or one object per line)")
+    parser.add_argument("-alignments_field", type=str, nargs="+", default=["alignments.relative"], help="Alignments fields in json objects (e.g. alignments.relative alignments.absolute). With several fields, each output file name includes the field")
     parser.add_argument("-output_prefix", type=str, required=True, help="Output file prefix")
 
     args = parser.parse_args()
 
-    with open(args.json) as fin:
-        j = json.load(fin)
-
     d = os.path.dirname(args.output_prefix)
     if not os.path.exists(d) and len(d)>0:
         os.makedirs(d)
 
-    files = {}
-
-    for o in j:
-        pairs = o[args.alignments_field]
-        left = " | ".join(p[0] for p in pairs)
-        right = " | ".join(p[1] for p in pairs)
-        split = o["data_split"]
-        if split not in files:
-            files[split] = open("{}.{}".format(args.output_prefix, split), "w")
-        fout = files[split]
-        fout.write("{}\t{}\n".format(left,right))
-
-    for key,fout in files.items():
-        fout.close()
+    counts = extract(args.json, args.alignments_field, args.output_prefix)
+    for file_name in sorted(counts.keys()):
+        print "Wrote %d pairs to %s" % (counts[file_name], file_name)
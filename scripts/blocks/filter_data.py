@@ -39,6 +39,7 @@ if __name__ == "__main__":
     parser.add_argument("-bitmap_dim", type=int, default=15, help="(Only used if compute_distances = True) Width of bitmap in blocks (assumed square)")
     parser.add_argument("-image_field", type=str, default="Input.Image_url", help="(Only used if compute_distances = True) Name of CSV field containing image URL")
     parser.add_argument("-draw_events_field", type=str, default="Answer.WritingTexts", help="(Only used if compute_distances = True) Name of CSV field containing drawing task events")
+    parser.add_argument("-workers", type=int, default=1, help="(Only used if compute_distances = True) Number of processes to compute Hamming distances with")
 
     args = parser.parse_args()
     input_file = args.csv
@@ -51,7 +52,7 @@ if __name__ == "__main__":
         generator = BitmapMaker(args.bitmap_dim, args.bitmap_dim)
         image_url_field = args.image_field
         actions_field = args.draw_events_field
-        data_with_distance, file_header = evaluate.get_hamming_distances(args.csv, args.image_dir, args.output, generator, image_url_field, actions_field)
+        data_with_distance, file_header = evaluate.get_hamming_distances(args.csv, args.image_dir, args.output, generator, image_url_field, actions_field, args.workers)
     else:
         data_with_distance, file_header = utils.read_csv(input_file)
 
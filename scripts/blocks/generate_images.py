@@ -19,6 +19,21 @@ def printpic(bitmap):
     print("")
 
 
+def add_to_frontier(dot, k, offsets, active, dot_index, bitmap):
+    # places dot k: its cell is no longer a free neighbor of any earlier dot, and its own free neighbors become events
+    X,Y = bitmap.shape
+    S = len(offsets)
+    bitmap[dot] = 1
+    dot_index[dot] = k
+    for (o,(dx,dy)) in enumerate(offsets):
+        x,y = dot[0]-dx, dot[1]-dy
+        if 0 <= x < X and 0 <= y < Y and dot_index[x,y] >= 0:
+            active[dot_index[x,y]*S + o] = False
+        x,y = dot[0]+dx, dot[1]+dy
+        if 0 <= x < X and 0 <= y < Y and bitmap[x,y] == 0:
+            active[k*S + o] = True
+
+
 def generate_bitmap_and_commands(ndots, dim, stayprob, keepdirprob, diag, randstart):
     int_t = np.dtype(np.int32)
     bitmap = np.zeros((dim,dim),dtype=int_t)
@@ -31,50 +46,42 @@ def generate_bitmap_and_commands(ndots, dim, stayprob, keepdirprob, diag, randst
 
     commands = ["START"]
     actions = ["ADD {} {}".format(firstdot[0],firstdot[1])]
-    bitmap[firstdot] = 1
     dots.append(firstdot)
     momentum = (0,0)
 
-    for k in range(1,ndots):
-        # for each antecedent, for each neighbor, accumulate probability to neighbor
-        # pick from this probability distribution
-        X,Y = bitmap.shape
-        events = []
-        probs = np.zeros((0,))
-        for dot in dots[:-1]:
-            for x in [dot[0]-1,dot[0],dot[0]+1]:
-                for y in [dot[1]-1,dot[1],dot[1]+1]:
-                    newdot = (x,y)
-                    if x in range(X) and y in range(Y) and bitmap[newdot]==0:
-                        if not diag and x != dot[0] and y != dot[1]:
-                            continue
-                  
-                        antecedentprob = (1-stayprob)/len(dots[:-1])
-                        probs = np.append(probs, antecedentprob * .125)
-                        events.append((dot,newdot))
+    # The candidate events are (antecedent, neighbor) pairs: every earlier dot with each of its free neighbor cells.
+    # Pair S*i+o is dot i with the neighbor at offsets[o], so that the active pairs, in index order, are the events in
+    # the order they are sampled from: earlier dots first, in the order they were placed, then the last dot.
+    offsets = [(dx,dy) for dx in [-1,0,1] for dy in [-1,0,1] if (dx,dy) != (0,0) and (diag or dx == 0 or dy == 0)]
+    S = len(offsets)
+    active = np.zeros(ndots*S, dtype=bool)
+    dot_index = -np.ones((dim,dim), dtype=int_t)
+    add_to_frontier(firstdot, 0, offsets, active, dot_index, bitmap)
 
+    for k in range(1,ndots):
+        # earlier dots share 1-stayprob equally, and the last dot gets stayprob, split by momentum
         lastdot = dots[-1]
-        for x in [lastdot[0]-1,lastdot[0],lastdot[0]+1]:
-            for y in [lastdot[1]-1,lastdot[1],lastdot[1]+1]:
-                newdot = (x,y)
-                if x in range(X) and y in range(Y) and bitmap[newdot]==0:
-                    if not diag and x != lastdot[0] and y != lastdot[1]:
-                        continue
-                    antecedentprob = stayprob
-                    if momentum == (0,0):
-                        newprob = antecedentprob * .125
-                    elif momentum == (x-lastdot[0], y-lastdot[1]):
-                        newprob = antecedentprob * keepdirprob
-                    else:
-                        newprob = antecedentprob * (1-keepdirprob)/7
-                    probs = np.append(probs, newprob)
-                    events.append((lastdot, newdot))
+        events = np.flatnonzero(active[:k*S])
+        num_earlier = np.searchsorted(events, (k-1)*S)
+        probs = np.empty(len(events))
+        if num_earlier > 0:
+            probs[:num_earlier] = (1-stayprob)/(k-1) * .125
+        for (i,pair) in enumerate(events[num_earlier:], num_earlier):
+            antecedentprob = stayprob
+            if momentum == (0,0):
+                probs[i] = antecedentprob * .125
+            elif momentum == offsets[pair - (k-1)*S]:
+                probs[i] = antecedentprob * keepdirprob
+            else:
+                probs[i] = antecedentprob * (1-keepdirprob)/7
         if np.sum(probs) < .001:
             break
         probs = probs / np.sum(probs)
-        prevdot,newdot = events[np.random.choice(len(events),p=probs)]
-        momentum = (newdot[0]-prevdot[0], newdot[1]-prevdot[1])
-        bitmap[newdot] = 1
+        pair = events[np.random.choice(len(events),p=probs)]
+        prevdot = dots[pair // S]
+        momentum = offsets[pair % S]
+        newdot = (prevdot[0]+momentum[0], prevdot[1]+momentum[1])
+        add_to_frontier(newdot, k, offsets, active, dot_index, bitmap)
         dots.append(newdot)
 
         if prevdot != lastdot:
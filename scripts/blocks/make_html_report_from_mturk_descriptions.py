@@ -65,7 +65,7 @@ if __name__ == "__main__":
             total_work_time += work_time
                 
             lines = [s.strip() for s in description.replace("\r","").split("\n")]
-            words = itertools.chain(*[tokenizer.tokenize(l) for l in lines])
+            words = itertools.chain(*tokenizer.tokenize_batch(lines))
             for w in words:
                 wordcounts.setdefault(w.lower(),0)
                 wordcounts[w.lower()] += 1
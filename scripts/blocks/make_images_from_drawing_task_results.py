@@ -33,8 +33,7 @@ if __name__ == "__main__":
         for i,row in enumerate(reader):
             commands_str = row[colindex]
             bmpmaker.clear()
-            event_sequence = AbsoluteEventSequence.from_mturk_string(commands_str)
-            event_sequence = event_sequence.canonicalize()
+            event_sequence = AbsoluteEventSequence.from_mturk_string(commands_str, canonicalize=True)
             canonical_events = event_sequence.events
             bmpmaker.process_commands(canonical_events)
             bitmap = bmpmaker.bitmap
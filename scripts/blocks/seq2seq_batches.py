@@ -0,0 +1,119 @@
+'''
+Batches of seq2seq training examples, grouped by length so that little of each batch is padding. Examples are read one
+at a time, either from the aligned TSV files written by extract_seq2seq.py or from the shards of encode_seq2seq.py, and
+collected into a buffer of at most buffer_size examples. Each full buffer is shuffled, sorted by length and cut into
+batches of at most max_tokens source or target ids (padding included), which are then yielded in random order. Memory
+use is bounded by the buffer, whatever the size of the data.
+Run python seq2seq_batches.py -h to print statistics for a dataset.
+'''
+import argparse
+import random
+from collections import namedtuple
+import numpy as np
+from encode_seq2seq import load_vocabulary, Seq2SeqShard, pad_id, unk_id, segment_marker
+
+# source and target are (batch size, longest length) int32 arrays of ids padded with pad_id
+Batch = namedtuple("Batch", ["source", "source_lengths", "target", "target_lengths"])
+
+
+def iter_tsv_examples(paths, source_vocabulary, target_vocabulary):
+    # (source ids, target ids) of every line of the seq2seq files, without the " | " markers, encoded as by encode_seq2seq
+    source_ids = dict((token, token_id) for (token_id, token) in enumerate(source_vocabulary))
+    target_ids = dict((token, token_id) for (token_id, token) in enumerate(target_vocabulary))
+    for path in paths:
+        with open(path) as fin:
+            for line in fin:
+                (source, target) = line.rstrip("\n").split("\t")
+                yield ([source_ids.get(token, unk_id) for token in source.split() if token != segment_marker],
+                       [target_ids.get(token, unk_id) for token in target.split() if token != segment_marker])
+
+
+def iter_shard_examples(shard):
+    for i in range(len(shard)):
+        yield (shard.ids(i, "source"), shard.ids(i, "target"))
+
+
+def pad(sequences):
+    lengths = np.array([len(sequence) for sequence in sequences], dtype=np.int32)
+    padded = np.empty((len(sequences), lengths.max() if len(sequences) else 0), dtype=np.int32)
+    padded.fill(pad_id)
+    for (i, sequence) in enumerate(sequences):
+        padded[i, :lengths[i]] = sequence
+    return padded, lengths
+
+
+def token_budget_batches(examples, max_tokens):
+    # cuts examples, already sorted by length, into lists whose padded source and target each hold at most max_tokens
+    # ids; an example longer than max_tokens is a batch of its own
+    batch = []
+    longest = (0, 0)
+    for example in examples:
+        candidate = (max(longest[0], len(example[0])), max(longest[1], len(example[1])))
+        if batch and max(candidate) * (len(batch) + 1) > max_tokens:
+            yield batch
+            batch = []
+            candidate = (len(example[0]), len(example[1]))
+        batch.append(example)
+        longest = candidate
+    if batch:
+        yield batch
+
+
+def bucketed_batches(examples, max_tokens=4096, buffer_size=10000, rng=None):
+    '''
+    Yields a Batch for every group of similar-length examples from the (source ids, target ids) pairs in examples.
+    With an rng (a random.Random), each buffer is shuffled before sorting, so that examples of equal length are
+    grouped differently every epoch, and its batches are yielded in random order; without one the order is fixed.
+    '''
+    buffer = []
+    for example in examples:
+        buffer.append(example)
+        if len(buffer) >= buffer_size:
+            for batch in buffer_batches(buffer, max_tokens, rng):
+                yield batch
+            buffer = []
+    for batch in buffer_batches(buffer, max_tokens, rng):
+        yield batch
+
+
+def buffer_batches(buffer, max_tokens, rng):
+    if rng is not None:
+        rng.shuffle(buffer)
+    buffer.sort(key=lambda example: (len(example[0]), len(example[1])))
+    batches = list(token_budget_batches(buffer, max_tokens))
+    if rng is not None:
+        rng.shuffle(batches)
+    for batch in batches:
+        (source, source_lengths) = pad([example[0] for example in batch])
+        (target, target_lengths) = pad([example[1] for example in batch])
+        yield Batch(source, source_lengths, target, target_lengths)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-tsv", type=str, nargs="+", default=[], help="seq2seq files to batch (e.g. data/Batch_2128112/Batch_2128112.seq2seq.rel.aligned.train)")
+    parser.add_argument("-shard", type=str, default="", help="Split of the -vocab_dir shards to batch instead of -tsv files")
+    parser.add_argument("-vocab_dir", type=str, required=True, help="Output directory of encode_seq2seq.py, with the vocabularies")
+    parser.add_argument("-max_tokens", type=int, default=4096, help="Most source or target ids in a batch, padding included")
+    parser.add_argument("-buffer_size", type=int, default=10000, help="Number of examples to sort into batches at a time")
+    parser.add_argument("-rseed", type=int, default=0, help="Random seed for shuffling")
+    args = parser.parse_args()
+
+    if args.shard:
+        examples = iter_shard_examples(Seq2SeqShard(args.vocab_dir, args.shard))
+    elif args.tsv:
+        examples = iter_tsv_examples(args.tsv, load_vocabulary(args.vocab_dir, "source"), load_vocabulary(args.vocab_dir, "target"))
+    else:
+        parser.error("Give -tsv files or a -shard split to batch")
+
+    num_batches = 0
+    num_examples = 0
+    tokens = 0
+    padded_tokens = 0
+    for batch in bucketed_batches(examples, args.max_tokens, args.buffer_size, random.Random(args.rseed)):
+        num_batches += 1
+        num_examples += len(batch.source)
+        tokens += batch.source_lengths.sum() + batch.target_lengths.sum()
+        padded_tokens += batch.source.size + batch.target.size
+    print "%d examples in %d batches" % (num_examples, num_batches)
+    print "Padding: %.1f%% of %d ids" % (100.0 * (padded_tokens - tokens) / max(padded_tokens, 1), padded_tokens)
@@ -0,0 +1,56 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from create_dataset import BuildManifest, update_data
+
+
+class IncrementalBuildTest(unittest.TestCase):
+    line = json.dumps({"sample_id": 0}) + "\n"
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.output_file = os.path.join(self.dir, "data.jsonl")
+        self.manifest_file = self.output_file + ".manifest.json"
+        with open(self.output_file, "w") as fout:
+            fout.write(self.line)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def update(self):
+        update_data([], BuildManifest(self.manifest_file), 0, 1, 2, 3, self.output_file, 0.67, 0.17, 0.16,
+                    include_bitmaps=False, align_cache=None)
+
+    def output(self):
+        with open(self.output_file) as fin:
+            return fin.read()
+
+    def save_manifest(self, output_bytes):
+        manifest = BuildManifest(self.manifest_file)
+        manifest.assignments = {"A": [0, 0]}
+        manifest.output_bytes = output_bytes
+        manifest.save()
+
+    def test_output_without_manifest_is_kept(self):
+        self.assertRaises(Exception, self.update)
+        self.assertEqual(self.output(), self.line)
+        self.assertFalse(os.path.exists(self.manifest_file))
+
+    def test_output_smaller_than_manifest_is_kept(self):
+        self.save_manifest(len(self.line) + 10)
+        self.assertRaises(Exception, self.update)
+        self.assertEqual(self.output(), self.line)
+
+    def test_unfinished_build_is_discarded(self):
+        self.save_manifest(len(self.line))
+        with open(self.output_file, "a") as fout:
+            fout.write('{"sample_id": 1, "trunc')
+        self.update()
+        self.assertEqual(self.output(), self.line)
+        self.assertEqual(BuildManifest(self.manifest_file).output_bytes, len(self.line))
+
+
+if __name__ == "__main__":
+    unittest.main()
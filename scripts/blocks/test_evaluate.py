@@ -0,0 +1,31 @@
+import unittest
+import update_eval_json
+from evaluate import evaluate_sequences
+from events import AbsoluteEventSequence
+
+
+class OffGridScoringTest(unittest.TestCase):
+    # the prediction repeats the reference and then draws three blocks at negative columns
+    y_ref = "START PUT 0 1 PUT 0 1"
+    y_pred = "START PUT 0 1 PUT 0 1 PUT 0 -20 PUT 0 -1 PUT 0 -1"
+
+    def score(self, sparse):
+        update_eval_json.width = 25
+        [example] = update_eval_json.update_json([{"y_ref": self.y_ref, "y_pred": self.y_pred}], "relative", sparse=sparse)
+        return example["hamming_distance"]
+
+    def test_off_grid_blocks_count(self):
+        self.assertEqual(self.score(sparse=False), 3)
+        self.assertEqual(self.score(sparse=True), 3)
+
+    def test_evaluate_sequences(self):
+        on_grid = AbsoluteEventSequence([["ADD", 1, 1], ["ADD", 1, 2]])
+        off_grid = AbsoluteEventSequence([["ADD", 1, 1], ["ADD", 1, 2], ["ADD", 1, -3]])
+        distances, shifts, num_off_grid = evaluate_sequences([on_grid, on_grid, off_grid], [on_grid, off_grid, off_grid], (5, 5))
+        self.assertEqual(distances.tolist(), [0, 1, 0])
+        self.assertEqual(num_off_grid, 2)
+        self.assertEqual(shifts.shape, (3, 2))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,28 @@
+import unittest
+from events import AbsoluteEventSequence, RelativeEventSequence, parse_eval_strings
+
+
+class CoordinateRangeTest(unittest.TestCase):
+
+    def test_large_coordinates_are_kept(self):
+        seq = RelativeEventSequence.from_eval_str("START PUT 40000 1 PUT -70000 2")
+        self.assertEqual(seq.events, [["START"], ["PUT", 40000, 1], ["PUT", -70000, 2]])
+        (ops, coords, offsets) = parse_eval_strings(["START PUT 40000 1"])
+        self.assertEqual(coords.tolist(), [[0, 0], [40000, 1]])
+
+    def test_long_relative_walk(self):
+        rel = RelativeEventSequence.from_eval_str("START" + " PUT 0 20000" * 5)
+        absolute = AbsoluteEventSequence.from_relative(rel, 25, 25)
+        self.assertEqual(absolute.events[-1], ["ADD", 12, 100012])
+        self.assertEqual(RelativeEventSequence.from_absolute(absolute).events[1:], rel.events[1:])
+
+    def test_out_of_range_coordinates_raise(self):
+        self.assertRaises(ValueError, RelativeEventSequence.from_eval_str, "START PUT 40000 1 PUT 99999999999 2")
+        self.assertRaises(ValueError, parse_eval_strings, ["START PUT 99999999999 2"])
+        self.assertRaises(ValueError, AbsoluteEventSequence, [["ADD", 2 ** 40, 0]])
+        rel = RelativeEventSequence.from_eval_str("START" + " PUT 0 2000000000" * 2)
+        self.assertRaises(ValueError, AbsoluteEventSequence.from_relative, rel, 25, 25)
+
+
+if __name__ == "__main__":
+    unittest.main()
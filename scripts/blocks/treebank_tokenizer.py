@@ -15,6 +15,7 @@ and available at http://www.cis.upenn.edu/~treebank/tokenizer.sed.
 """
 
 import re
+from collections import OrderedDict
 #from nltk.tokenize.api import TokenizerI
 
 
@@ -54,36 +55,49 @@ class TreebankWordTokenizer(object):
     CONTRACTIONS4 = [re.compile(r"(?i)\b(whad)(dd)(ya)\b"),
                      re.compile(r"(?i)\b(wha)(t)(cha)\b")]
 
+    # The substitutions of tokenize(), in the order they are applied
+    STARTING_QUOTES = [(re.compile(r'^\"'), r'``'),
+                       (re.compile(r'(``)'), r' \1 '),
+                       (re.compile(r'([ (\[{<])"'), r'\1 `` ')]
+    PUNCTUATION = [(re.compile(r'([:,])([^\d])'), r' \1 \2'),
+                   (re.compile(r'([:,])$'), r' \1 '),
+                   (re.compile(r'\.\.\.'), r' ... '),
+                   (re.compile(r'[;@#$%&]'), r' \g<0> '),
+                   (re.compile(r'([^\.])(\.)([\]\)}>"\']*)\s*$'), r'\1 \2\3 '),
+                   (re.compile(r'[?!]'), r' \g<0> '),
+                   (re.compile(r"([^'])' "), r"\1 ' ")]
+    PARENS_BRACKETS = [(re.compile(r'[\]\[\(\)\{\}\<\>]'), r' \g<0> '),
+                       (re.compile(r'--'), r' -- ')]
+    ENDING_QUOTES = [(re.compile(r'"'), " '' "),
+                     (re.compile(r'(\S)(\'\')'), r'\1 \2 '),
+                     (re.compile(r"([^' ])('[sS]|'[mM]|'[dD]|') "), r"\1 \2 "),
+                     (re.compile(r"([^' ])('ll|'LL|'re|'RE|'ve|'VE|n't|N'T) "), r"\1 \2 ")]
+    PERIOD = re.compile(r'\.')
+
+    def __init__(self, cache_size=100000):
+        # tokenize_batch() keeps the tokens of the last cache_size distinct lines it has seen
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
     def tokenize(self, text):
         #starting quotes
-        text = re.sub(r'^\"', r'``', text)
-        text = re.sub(r'(``)', r' \1 ', text)
-        text = re.sub(r'([ (\[{<])"', r'\1 `` ', text)
+        for (regexp, substitution) in self.STARTING_QUOTES:
+            text = regexp.sub(substitution, text)
 
         #punctuation
-        text = re.sub(r'([:,])([^\d])', r' \1 \2', text)
-        text = re.sub(r'([:,])$', r' \1 ', text)
-        text = re.sub(r'\.\.\.', r' ... ', text)
-        text = re.sub(r'[;@#$%&]', r' \g<0> ', text)
-        text = re.sub(r'([^\.])(\.)([\]\)}>"\']*)\s*$', r'\1 \2\3 ', text)
-        text = re.sub(r'[?!]', r' \g<0> ', text)
-
-        text = re.sub(r"([^'])' ", r"\1 ' ", text)
+        for (regexp, substitution) in self.PUNCTUATION:
+            text = regexp.sub(substitution, text)
 
         #parens, brackets, etc.
-        text = re.sub(r'[\]\[\(\)\{\}\<\>]', r' \g<0> ', text)
-        text = re.sub(r'--', r' -- ', text)
+        for (regexp, substitution) in self.PARENS_BRACKETS:
+            text = regexp.sub(substitution, text)
 
         #add extra space to make things easier
         text = " " + text + " "
 
         #ending quotes
-        text = re.sub(r'"', " '' ", text)
-        text = re.sub(r'(\S)(\'\')', r'\1 \2 ', text)
-
-        text = re.sub(r"([^' ])('[sS]|'[mM]|'[dD]|') ", r"\1 \2 ", text)
-        text = re.sub(r"([^' ])('ll|'LL|'re|'RE|'ve|'VE|n't|N'T) ", r"\1 \2 ",
-                      text)
+        for (regexp, substitution) in self.ENDING_QUOTES:
+            text = regexp.sub(substitution, text)
 
         for regexp in self.CONTRACTIONS2:
             text = regexp.sub(r' \1 \2 ', text)
@@ -96,7 +110,22 @@ class TreebankWordTokenizer(object):
         #     text = regexp.sub(r' \1 \2 \3 ', text)
 
         # mkayser change
-        text = re.sub(r'\.',' . ', text).strip()
+        text = self.PERIOD.sub(' . ', text).strip()
 
         return text.split()
 
+    def tokenize_batch(self, lines):
+        """
+        Tokenizes every line of lines, as tokenize() would. Lines seen recently (including earlier in the same batch)
+        are looked up in an LRU cache instead of being tokenized again.
+        """
+        result = []
+        for line in lines:
+            tokens = self.cache.pop(line, None)
+            if tokens is None:
+                tokens = self.tokenize(line)
+            self.cache[line] = tokens
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+            result.append(list(tokens))
+        return result
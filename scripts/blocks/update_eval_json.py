@@ -1,43 +1,39 @@
 __author__ = 'anushabala'
 from argparse import ArgumentParser
-import json
-from bitmap import BitmapMaker
-from evaluate import evaluate
-from events import AbsoluteEventSequence, RelativeEventSequence, CursorEventSequence
-import numpy as np
+from itertools import islice
+from bitmap import SparseBitmap
+from evaluate import evaluate_batch, evaluate_sequences
+from events import AbsoluteEventSequence, RelativeEventSequence, CursorEventSequence, parse_eval_strings
+from utils import iter_json_objects, json_file_format, json_formats, JsonObjectWriter
 
-def update_json(inp_data, mode):
+def update_json(inp_data, mode, workers=1, sparse=False):
+    if mode == "relative":
+        (sequence_class, to_absolute) = (RelativeEventSequence, AbsoluteEventSequence.from_relative)
+    elif mode == "cursor":
+        (sequence_class, to_absolute) = (CursorEventSequence, AbsoluteEventSequence.from_cursor)
+        if sparse:
+            to_absolute = lambda seq, gridx, gridy: AbsoluteEventSequence.from_cursor(seq, gridx, gridy, bounded=False)
+    else:
+        raise Exception("Unknown or unsupported mode: {}".format(mode))
+    true_sequences = sequence_class.split_packed(*parse_eval_strings([example["y_ref"] for example in inp_data], mode))
+    pred_sequences = sequence_class.split_packed(*parse_eval_strings([example["y_pred"] for example in inp_data], mode))
+
+    true_absolute = [to_absolute(true_seq, width, width) for true_seq in true_sequences]
+    pred_absolute = [to_absolute(pred_seq, width, width) for pred_seq in pred_sequences]
     updated_data = []
-    ctr = 0
-    for example in inp_data:
-        bmpmaker.clear()
-        if mode == "relative":
-            true_seq_relative = RelativeEventSequence.from_eval_str(example["y_ref"])
-            true_events_absolute = AbsoluteEventSequence.from_relative(true_seq_relative, width, width).events
-            pred_seq_relative = RelativeEventSequence.from_eval_str(example["y_pred"])
-            pred_events_absolute = AbsoluteEventSequence.from_relative(pred_seq_relative, width, width).events
-        elif mode == "cursor":
-            true_seq_cursor = CursorEventSequence.from_eval_str(example["y_ref"])
-            true_events_absolute = AbsoluteEventSequence.from_cursor(true_seq_cursor, width, width).events
-            pred_seq_cursor = CursorEventSequence.from_eval_str(example["y_pred"])
-            pred_events_absolute = AbsoluteEventSequence.from_cursor(pred_seq_cursor, width, width).events
+    if inp_data:
+        if sparse:
+            # sparse boards keep every block, so the scores do not depend on the grid width
+            true_bitmaps = [SparseBitmap.from_events(seq) for seq in true_absolute]
+            pred_bitmaps = [SparseBitmap.from_events(seq) for seq in pred_absolute]
+            hamming_distances, shifts = evaluate_batch(true_bitmaps, pred_bitmaps, workers=workers)
         else:
-            raise Exception("Unknown or unsupported mode: {}".format(mode))
-            
-
-        bmpmaker.process_commands(true_events_absolute)
-        true_bitmap = np.array(bmpmaker.bitmap)
-
-        bmpmaker.clear()
-        bmpmaker.process_commands(pred_events_absolute)
-        pred_bitmap = np.array(bmpmaker.bitmap)
-        hamming = evaluate(true_bitmap, pred_bitmap)
-        example["hamming_distance"] = hamming
-        updated_data.append(example)
-        ctr+=1
-
-        if ctr % 500 == 0:
-            print "Progress: %d" % ctr
+            hamming_distances, shifts, num_off_grid = evaluate_sequences(true_absolute, pred_absolute, (width, width), workers=workers)
+            if num_off_grid:
+                print "Warning: %d examples have blocks outside the %dx%d grid; they were scored on sparse boards" % (num_off_grid, width, width)
+        for example, hamming in zip(inp_data, hamming_distances):
+            example["hamming_distance"] = int(hamming)
+            updated_data.append(example)
 
     return updated_data
 
@@ -53,14 +49,24 @@ if __name__ == "__main__":
     parser.add_argument("-width", type=int, default=25, help="Width of bitmap (assume square) - use larger number than size"
                                                             " of original bitmap to allow for conversion of relative sequences"
                                                              " to absolute sequences")
+    parser.add_argument("-workers", type=int, default=1, help="Number of processes to compute Hamming distances with")
+    parser.add_argument("-sparse", action="store_true", help="Score on unbounded sparse boards instead of a -width x -width grid, "
+                                                             "so that blocks drawn off the grid are never dropped")
+    parser.add_argument("-output_format", type=str, default="", choices=[""] + json_formats, help="Write a JSON array (json) or one "
+                                                                             "example per line (jsonl). Defaults to the input format.")
+    parser.add_argument("-chunk_size", type=int, default=10000, help="Number of examples to read and score at a time")
     args = parser.parse_args()
     input_file = args.json
     mode = args.mode
-    output_file = args.output if args.output else "%s-with-hamming.json" % (input_file[:input_file.rfind("/")]
-                                                                            + input_file[input_file.rfind("/"):].replace(".json", ""))
+    output_format = args.output_format if args.output_format else json_file_format(input_file)
+    input_name = input_file[input_file.rfind("/"):].replace(".jsonl", "").replace(".json", "")
+    output_file = args.output if args.output else "%s-with-hamming.%s" % (input_file[:input_file.rfind("/")] + input_name, output_format)
     width = args.width
-    input_data = json.load(open(input_file, 'Ur'))
-    bmpmaker = BitmapMaker(width, width)
 
-    output_data = update_json(input_data, mode)
-    json.dump(output_data, open(output_file, 'w'), sort_keys=True, indent=4)
+    examples = iter_json_objects(input_file)
+    with open(output_file, 'w') as fout:
+        writer = JsonObjectWriter(fout, output_format)
+        for chunk in iter(lambda: list(islice(examples, args.chunk_size)), []):
+            for example in update_json(chunk, mode, args.workers, args.sparse):
+                writer.write(example)
+        writer.close()
@@ -1,8 +1,122 @@
 __author__ = 'anushabala'
 import csv
+import json
+import re
+
+json_formats = ["json", "jsonl"]
+json_whitespace = re.compile(r"[ \t\n\r]*")
 
 def read_csv(inp):
     reader = csv.reader(open(inp, 'Ur'))
     header = next(reader) # skip header
     data = [row for row in reader]
     return header, data
+
+
+def json_file_format(path):
+    # "json" for a file holding one JSON array, "jsonl" for a file with one JSON object per line
+    with open(path) as fin:
+        for line in fin:
+            if line.strip():
+                return "json" if line.lstrip().startswith("[") else "jsonl"
+    return "jsonl"
+
+
+def iter_json_array(fin, chunk_size=1 << 20):
+    '''
+    Yields the elements of the JSON array in fin one at a time. The file is read chunk_size characters at a time, so
+    only the element being parsed (and the rest of its chunk) is ever in memory.
+    '''
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    eof = False
+    # what comes next: the opening "[", the first element or "]", an element, or the "," or "]" after an element
+    state = "start"
+    while True:
+        pos = json_whitespace.match(buf, pos).end()
+        if pos == len(buf):
+            if eof:
+                raise ValueError("Unexpected end of JSON array in {}".format(fin.name))
+            buf = fin.read(chunk_size)
+            pos = 0
+            eof = not buf
+            continue
+        char = buf[pos]
+        if state == "start":
+            if char != "[":
+                raise ValueError("Expected a JSON array in {}".format(fin.name))
+            pos += 1
+            state = "first"
+        elif state == "after" or (state == "first" and char == "]"):
+            if char == "]":
+                return
+            if char != ",":
+                raise ValueError("Expected , or ] after element of JSON array in {}".format(fin.name))
+            pos += 1
+            state = "element"
+        else:
+            try:
+                (obj, end) = decoder.raw_decode(buf, pos)
+                # a number that reaches the end of the buffer may continue in the next chunk
+                complete = eof or (end < len(buf) and buf[end] not in "0123456789.eE+-")
+            except ValueError:
+                if eof:
+                    raise
+                complete = False
+            if not complete:
+                # the element continues past the buffer: read at least as much again as the buffer holds
+                more = fin.read(max(chunk_size, len(buf) - pos))
+                buf = buf[pos:] + more
+                pos = 0
+                eof = not more
+                continue
+            yield obj
+            pos = end
+            state = "after"
+
+
+def iter_json_objects(path):
+    '''
+    Yields the objects stored in a JSON file, which either holds one array of objects or has one object per line.
+    Neither format is read into memory all at once.
+    '''
+    if json_file_format(path) == "json":
+        with open(path) as fin:
+            for obj in iter_json_array(fin):
+                yield obj
+        return
+    with open(path) as fin:
+        for line in fin:
+            if line.strip():
+                yield json.loads(line)
+
+
+class JsonObjectWriter(object):
+    '''
+    Writes objects to a file one at a time, either as a JSON array laid out exactly like
+    json.dump(objs, fout, indent=4, sort_keys=True) or as JSON lines. The file is flushed every flush_every objects, so
+    a JSON lines file keeps everything written before a crash. close() finishes the array but not the file.
+    '''
+
+    def __init__(self, fout, output_format="json", flush_every=100):
+        assert output_format in json_formats, "unknown JSON output format: {}".format(output_format)
+        self.fout = fout
+        self.output_format = output_format
+        self.flush_every = flush_every
+        self.count = 0
+
+    def write(self, obj):
+        if self.output_format == "jsonl":
+            self.fout.write(json.dumps(obj, sort_keys=True) + "\n")
+        else:
+            element = json.dumps(obj, indent=4, sort_keys=True).replace("\n", "\n    ")
+            self.fout.write(("[\n    " if self.count == 0 else ", \n    ") + element)
+        self.count += 1
+        if self.count % self.flush_every == 0:
+            self.fout.flush()
+
+    def close(self):
+        if self.output_format == "json":
+            self.fout.write("\n]" if self.count else "[]")
+        self.fout.flush()